@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+''' Silicon Labs Simplicity Commander backend for the ZRAD test station
+
+    One Commander object is kept for each WSTK (by serial number) and all of the commander.exe
+    operations the test station needs go through it. The results are parsed here and returned
+    as python values instead of every step of the test script splitting the text output itself.
+
+    This is NOT a persistent session: Commander has no documented long-lived, interactive or batch
+    mode, so every operation is still one commander process with its own debugger attach and the
+    object only holds the WSTK serial number and device name. What it saves is the shell - the process
+    is started directly instead of via shell=True which put cmd.exe or /bin/sh in front of every call.
+    Fewer commander processes per DUT come from Probe/DeviceState letting the test steps skip work.
+
+    Usage: python Commander.py <WSTK serial number> - prints the DUT state (SE version, lock, CTUNE and unique ID)
+'''
+import sys
+import re
+import subprocess
+import threading
+from collections import namedtuple
+import Metrics
+
+DEBUG = 3   # print debug messages - the higher the value, the more details are printed
+
+# path and executable to silabs commander
+CMDR = "C:/SiliconLabs/SimplicityStudio/v5/developer/adapter_packs/commander/commander.exe"
+
+DEVICE = "EFR32ZG23"
+
+# parsed result of "security status"
+SecurityStatus = namedtuple("SecurityStatus", ["se_version", "debug_locked"])
+
+class DeviceState:
+    ''' Snapshot of the DUT taken once when it is inserted (see Probe) so the test steps don't have to ask
+        Commander the same questions again. The steps update it as they change the DUT.
+    '''
+
+    def __init__(self, se_version=None, debug_locked=False, ctune=None, uid=None, app_matches=False):
+        self.se_version = se_version
+        self.debug_locked = debug_locked
+        self.ctune = ctune              # CTUNE token or None if not calibrated
+        self.uid = uid                  # EFR32 unique ID
+        self.app_matches = app_matches  # flash already holds the application file
+
+    def __repr__(self):
+        return("DeviceState(se_version={}, debug_locked={}, ctune={}, uid={}, app_matches={})".format(
+            self.se_version, self.debug_locked, self.ctune, self.uid, self.app_matches))
+
+class CommanderError(Exception):
+    ''' Commander ran but the output was not what was expected '''
+    pass
+
+class Commander:
+    ''' All the Commander operations for the DUT attached to one WSTK - one commander process per call '''
+
+    def __init__(self, wstkser, cmdr=CMDR, device=DEVICE):
+        self.wstkser = wstkser
+        self.cmdr = cmdr
+        self.device = device
+
+    def run(self, *args, device=True):
+        ''' run one commander command on this WSTK and return the output text with the CRs removed '''
+        cmd = [self.cmdr] + [str(a) for a in args]
+        if device:
+            cmd += ["-d", self.device]
+        cmd += ["--serialno", str(self.wstkser)]
+        if DEBUG>8: print(" ".join(cmd))
+        with Metrics.Timer("commander", " ".join(str(a) for a in args[:2])):
+            rtn = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        return(rtn.decode(errors="replace").replace('\r', ''))
+
+    def SecurityStatus(self):
+        ''' Returns SecurityStatus(se_version="2.2.6", debug_locked=False) '''
+        txt = self.run("security", "status")
+        seVer = None
+        locked = False
+        for line in txt.split('\n'):
+            if "SE Firmware" in line:
+                seVer = line.split(' ')[-1].strip()
+            elif "Debug lock" in line:
+                locked = "Enabled" in line
+        if seVer is None:
+            raise CommanderError("SE firmware version get failed:\n{}".format(txt))
+        return(SecurityStatus(seVer, locked))
+
+    def SecurityLock(self):
+        ''' Lock the debug port '''
+        return(self.run("security", "lock"))
+
+    def CtuneGet(self):
+        ''' Returns the CTUNE value stored in the user data token or None if it has not been set '''
+        txt = self.run("ctune", "get")
+        for line in txt.split('\n'):
+            if "Token" in line:
+                if "Not" in line:
+                    return(None)
+                m = re.search(r'(0x[0-9a-fA-F]+|\d+)\s*$', line)
+                if m:
+                    return(int(m.group(1), 0))
+        raise CommanderError("ctune get failed:\n{}".format(txt))
+
+    def CtuneSet(self, value):
+        return(self.run("ctune", "set", "--value", value))
+
+    def Flash(self, filename, masserase=False):
+        ''' Flash the file into the DUT - returns True if it completed successfully '''
+        args = ["flash"]
+        if masserase:
+            args.append("--masserase")
+        txt = self.run(*args, filename)
+        if "completed successfully" not in txt:
+            if DEBUG>1: print(txt)
+            return(False)
+        return(True)
+
+    def AemMeasure(self, windowlength=200):
+        ''' Returns the average current in milliAmps measured by the WSTK Advanced Energy Monitor '''
+        txt = self.run("aem", "measure", "--windowlength", windowlength, device=False)
+        for line in txt.split('\n'):
+            if "mA" in line:
+                m = re.search(r'(-?[0-9.]+)\s*mA', line)
+                if m:
+                    return(float(m.group(1)))
+        raise CommanderError("aem measure failed:\n{}".format(txt))
+
+    def ZwaveQRCode(self, timeout=1000):
+        ''' Returns the SmartStart QR code string computed by the DUT or an empty string '''
+        txt = self.run("device", "zwave-qrcode", "--timeout", timeout)
+        for line in txt.split('\n'):
+            if "QR code" in line:
+                qr = ""
+                for word in line.split(' '):
+                    if "90" in word:
+                        qr = word.strip()
+                return(qr)
+        return("")
+
+    def UniqueID(self):
+        ''' Returns the 64 bit unique ID of the EFR32 as a hex string IE: "588e81fffe75b7d3" '''
+        txt = self.run("device", "info")
+        for line in txt.split('\n'):
+            if "Unique ID" in line:
+                return(line.split(':')[-1].strip().lower())
+        raise CommanderError("device info failed:\n{}".format(txt))
+
+    def Verify(self, filename):
+        ''' Returns True if the flash of the DUT matches the file '''
+        try:
+            txt = self.run("verify", filename)
+        except subprocess.CalledProcessError as err:   # commander exits with an error if the flash is different
+            return(False)
+        return("successful" in txt.lower() and "fail" not in txt.lower())
+
+    def DeviceReset(self):
+        return(self.run("device", "reset"))
+
+    def DeviceUnlock(self):
+        ''' Unlock the debug port - this also runs a mass erase '''
+        return(self.run("device", "unlock"))
+
+    def PageErase(self, region):
+        return(self.run("device", "pageerase", "--region", region))
+
+def Probe(cmdr, appfile=None):
+    ''' Returns the DeviceState of the DUT - cmdr is a Commander or any object with the same methods.
+        The flash is only compared with appfile if the DUT has a CTUNE token - a fresh chip can't have the application yet.
+    '''
+    status = cmdr.SecurityStatus()
+    state = DeviceState(status.se_version, status.debug_locked)
+    if status.debug_locked:     # nothing else can be read until the DUT is unlocked
+        return(state)
+    state.ctune = cmdr.CtuneGet()
+    state.uid = cmdr.UniqueID()
+    if appfile is not None and state.ctune is not None:
+        state.app_matches = cmdr.Verify(appfile)
+    return(state)
+
+_commanders = {}
+_commanders_lock = threading.Lock()
+
+def GetCommander(wstkser, cmdr=CMDR):
+    ''' Returns the Commander object for this WSTK serial number - one per WSTK for the whole station '''
+    with _commanders_lock:
+        if wstkser not in _commanders:
+            _commanders[wstkser] = Commander(wstkser, cmdr)
+        return(_commanders[wstkser])
+
+def SetCommander(wstkser, cmdr):
+    ''' Use cmdr (any object with the Commander methods, IE: Simulator.FakeCommander) for this WSTK serial number '''
+    with _commanders_lock:
+        _commanders[wstkser] = cmdr
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python Commander.py <WSTK serial number>")
+        sys.exit(1)
+    cmdr = GetCommander(sys.argv[1])
+    print(Probe(cmdr))
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+''' Timing instrumentation and throughput report for the ZRAD test station
+
+    Every pipeline step, Commander call, RailTest command, TinySA sweep and shared resource wait is
+    recorded as an Event with its start time, duration, jig and outcome:
+
+        with Metrics.Timer("step", "CalibrateCrystal") as t:
+            t.ok = self.CalibrateCrystal()
+
+    The jig is taken from the thread (SetJig) since each jig has its own worker thread.
+    The events are kept in memory for Report() and are appended to a CSV file if Open() was called
+    so the report can be rebuilt later or the data loaded in a spreadsheet.
+
+    Usage: python Metrics.py [metrics.csv] - prints the report from the CSV file
+'''
+import sys
+import csv
+import math
+import time
+import threading
+from collections import namedtuple, defaultdict
+
+DEBUG = 3   # print debug messages - the higher the value, the more details are printed
+
+METRICS_FILE = "metrics.csv"
+FIELDS = ["start", "kind", "name", "jig", "duration", "ok"]
+
+# kind is one of dut, step, wait, commander, railtest or sweep
+Event = namedtuple("Event", FIELDS)
+
+_events = []
+_lock = threading.Lock()
+_file = None
+_writer = None
+_local = threading.local()
+
+def SetJig(name):
+    ''' the jig the events recorded by this thread belong to '''
+    _local.jig = name
+
+def Record(kind, name, start, duration, ok=True, jig=None):
+    if jig is None:
+        jig = getattr(_local, "jig", None)
+    event = Event(start, kind, name, jig, duration, bool(ok))
+    with _lock:
+        _events.append(event)
+        if _writer:
+            _writer.writerow(event)
+            _file.flush()
+
+class Timer:
+    ''' with Timer(kind, name) as t: ... - records the time the block took. Set t.ok = False if it failed.
+        An exception in the block is recorded as a failure.
+    '''
+
+    def __init__(self, kind, name, jig=None):
+        self.kind = kind
+        self.name = name
+        self.jig = jig
+        self.ok = True
+
+    def __enter__(self):
+        self.start = time.time()
+        return(self)
+
+    def __exit__(self, exc_type, exc, tb):
+        Record(self.kind, self.name, self.start, time.time()-self.start, self.ok and exc_type is None, self.jig)
+        return(False)
+
+def Open(filename=METRICS_FILE):
+    ''' append every event to the CSV file as well '''
+    global _file, _writer
+    with _lock:
+        new = True
+        try:
+            with open(filename) as f:
+                new = f.read(1) == ""
+        except OSError:
+            pass
+        _file = open(filename, "a", newline="")
+        _writer = csv.writer(_file)
+        if new:
+            _writer.writerow(FIELDS)
+
+def Events():
+    with _lock:
+        return(list(_events))
+
+def Reset():
+    with _lock:
+        del _events[:]
+
+def Load(filename=METRICS_FILE):
+    ''' the events in a CSV file written by Open() '''
+    with open(filename, newline="") as f:
+        return([Event(float(r["start"]), r["kind"], r["name"], r["jig"] or None, float(r["duration"]), r["ok"] == "True")
+                for r in csv.DictReader(f)])
+
+def Percentile(values, pct):
+    ''' nearest rank percentile of a sorted list '''
+    return(values[max(0, math.ceil(pct/100*len(values))-1)])
+
+def Report(events=None, timescale=1.0):
+    ''' The station report as a string: units per hour, the p50/p95 time of every operation, jig idle time
+        and the bottleneck step. timescale multiplies the times (IE: the Simulator speed).
+    '''
+    if events is None:
+        events = Events()
+    out = []
+    duts = [e for e in events if e.kind == "dut"]
+    if duts:
+        first = min(e.start for e in duts)
+        span = (max(e.start+e.duration for e in duts) - first)*timescale
+        good = sum(1 for e in duts if e.ok)
+        out.append("{} DUTs, {} good in {:.0f}s = {:.0f} units per hour".format(len(duts), good, span, 3600*len(duts)/max(span, 1e-6)))
+        byjig = defaultdict(list)
+        for e in duts:
+            byjig[e.jig].append(e)
+        for jig, jigduts in sorted(byjig.items(), key=lambda j: str(j[0])):
+            busy = sum(e.duration for e in jigduts)*timescale
+            out.append("  {}: {} DUTs, busy {:.0f}s, idle {:.0f}s ({:.0f}%)".format(jig, len(jigduts), busy, span-busy, 100*(span-busy)/max(span, 1e-6)))
+    groups = defaultdict(list)
+    for e in events:
+        if e.kind != "dut":
+            groups[(e.kind, e.name)].append(e)
+    if groups:
+        out.append("{:10} {:28} {:>6} {:>6} {:>8} {:>8} {:>9}".format("kind", "name", "count", "fails", "p50", "p95", "total"))
+    for (kind, name), group in sorted(groups.items(), key=lambda g: (g[0][0], -sum(e.duration for e in g[1]))):
+        durations = sorted(e.duration*timescale for e in group)
+        out.append("{:10} {:28} {:6} {:6} {:8.2f} {:8.2f} {:9.1f}".format(kind, name[:28], len(group),
+            sum(1 for e in group if not e.ok), Percentile(durations, 50), Percentile(durations, 95), sum(durations)))
+    steps = {name: sum(e.duration for e in group)/len(group) for (kind, name), group in groups.items() if kind == "step"}
+    if steps:
+        # the steps are timed including the wait for the shared instruments so a step stuck behind another jig shows up here
+        bottleneck = max(steps, key=steps.get)
+        out.append("Bottleneck step: {} - {:.1f}s per DUT on average".format(bottleneck, steps[bottleneck]*timescale))
+    return("\n".join(out))
+
+if __name__ == "__main__":
+    print(Report(Load(sys.argv[1] if len(sys.argv) > 1 else METRICS_FILE)))
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+''' Background label print spooler for the ZRAD test station
+
+    The test pipeline only enqueues the ZPL for the labels of each DUT and moves on to locking the DUT.
+    A background thread sends the jobs to the Zebra printer once it is ready, retrying until it works,
+    so a slow, jammed or out of labels printer no longer stalls the station.
+
+    Every job is a JSON file in SPOOL_DIR/queue until it has printed and is then moved to SPOOL_DIR/printed.
+    Jobs left in the queue when the station is stopped are printed the next time it starts.
+    The last PRINTED_KEEP printed jobs are kept so any DUT can be reprinted by its DSK (or PIN) or serial number
+    without re-testing it. SPOOL_DIR/printed/index.jsonl has one line per printed job (id, DSK and serial number)
+    so a reprint only reads the index and the one job it finds.
+
+    Usage: python PrintSpooler.py                 - list the queued jobs
+           python PrintSpooler.py <DSK or serial> - reprint the labels of that DUT
+'''
+import os
+import sys
+import json
+import time
+import glob
+import platform
+import uuid
+import threading
+import subprocess
+
+DEBUG = 3   # print debug messages - the higher the value, the more details are printed
+
+SPOOL_DIR = "spool"
+RETRY_DELAY = 2         # seconds before retrying a job the first time - doubles on every failure
+RETRY_DELAY_MAX = 60    # seconds
+PRINTED_KEEP = 20000    # printed jobs kept for reprints - the oldest are deleted
+PRUNE_EVERY = 500       # printed jobs between checks of PRINTED_KEEP
+INDEX_FILE = "index.jsonl"
+
+def PrinterStatus(queue):
+    ''' Returns (ready, reason) for the printer queue.
+        Linux/macOS asks CUPS with lpstat. Windows asks the spooler with pywin32 if it is installed.
+        If the status can't be read the printer is assumed to be ready and a failed job is simply retried.
+    '''
+    if platform.system() == "Windows":
+        try:
+            import win32print
+        except ImportError:
+            return(True, "unknown")
+        h = win32print.OpenPrinter(queue)
+        try:
+            info = win32print.GetPrinter(h, 2)
+        finally:
+            win32print.ClosePrinter(h)
+        if info["Attributes"] & win32print.PRINTER_ATTRIBUTE_WORK_OFFLINE:
+            return(False, "offline")
+        if info["Status"] != 0:
+            return(False, "status 0x{:x}".format(info["Status"]))
+        return(True, "ready")
+    try:
+        txt = subprocess.check_output(["lpstat", "-p", queue], stderr=subprocess.STDOUT).decode(errors="replace")
+    except (OSError, subprocess.CalledProcessError) as err:
+        return(True, "unknown")
+    if "disabled" in txt:
+        return(False, txt.strip())
+    return(True, "ready")
+
+def DSKPrefix(key):
+    ''' the digits of key if it is a PIN or (part of) a DSK with or without the dashes - otherwise None
+        so a serial number or unique ID with digits in it never matches a DSK
+    '''
+    key = str(key).replace("-", "")
+    if len(key) < 5 or not key.isdigit():
+        return(None)
+    return(key)
+
+class PrintSpooler:
+    ''' Persistent on-disk print queue with a background thread sending the jobs to the printer '''
+
+    def __init__(self, printer=None, spooldir=SPOOL_DIR, setup=None):
+        ''' printer is the zebra.Zebra object (queue already set) - None only allows queuing and reprint lookups
+            setup is ZPL (IE: the logo) sent before the first job and again whenever the printer recovers
+            from an error since it may have been power cycled.
+        '''
+        self.printer = printer
+        self.setup = setup
+        self.needsetup = setup is not None
+        self.queuedir = os.path.join(spooldir, "queue")
+        self.printeddir = os.path.join(spooldir, "printed")
+        self.indexfile = os.path.join(self.printeddir, INDEX_FILE)
+        os.makedirs(self.queuedir, exist_ok=True)
+        os.makedirs(self.printeddir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.printed = 0
+        self.status = "idle"
+        self.thread = None
+
+    def start(self):
+        self.Prune()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return(self)
+
+    def Enqueue(self, zplcode, qr=None, serial=None):
+        ''' Queue the labels of one DUT - returns immediately '''
+        now = time.time()
+        jobid = "{}{:03d}_{}".format(time.strftime("%Y%m%d%H%M%S", time.localtime(now)), int(now*1000) % 1000,
+                                     uuid.uuid4().hex[:12])    # sorts by time, unique across processes
+        job = {"id": jobid, "time": now, "qr": qr, "dsk": qr[12:52] if qr else None, "serial": serial,
+               "zpl": zplcode, "attempts": 0}
+        self.write(os.path.join(self.queuedir, jobid + ".json"), job)
+        self.wake.set()
+        return(jobid)
+
+    def write(self, filename, job):
+        tmp = filename + ".tmp"     # write then rename so a power failure never leaves half a job
+        with open(tmp, "w") as f:
+            json.dump(job, f)
+        os.replace(tmp, filename)
+
+    def Queued(self):
+        ''' file names of the jobs waiting to print, oldest first '''
+        return(sorted(glob.glob(os.path.join(self.queuedir, "*.json"))))
+
+    def Index(self):
+        ''' [{"id", "dsk", "serial"}] of the printed jobs, oldest first - rebuilt from the job files if there is no index '''
+        if not os.path.exists(self.indexfile):
+            entries = []
+            for filename in sorted(glob.glob(os.path.join(self.printeddir, "*.json"))):
+                with open(filename) as f:
+                    job = json.load(f)
+                entries.append({"id": job["id"], "dsk": job["dsk"], "serial": job["serial"]})
+            self.WriteIndex(entries)
+            return(entries)
+        with open(self.indexfile) as f:
+            return([json.loads(line) for line in f if line.strip()])
+
+    def WriteIndex(self, entries):
+        tmp = self.indexfile + ".tmp"
+        with open(tmp, "w") as f:
+            f.writelines(json.dumps(e) + "\n" for e in entries)
+        os.replace(tmp, self.indexfile)
+
+    def Prune(self):
+        ''' delete the oldest printed jobs beyond PRINTED_KEEP '''
+        with self.lock:
+            entries = self.Index()
+            if len(entries) <= PRINTED_KEEP:
+                return
+            for e in entries[:-PRINTED_KEEP]:
+                try:
+                    os.remove(os.path.join(self.printeddir, e["id"] + ".json"))
+                except FileNotFoundError:
+                    pass
+            self.WriteIndex(entries[-PRINTED_KEEP:])
+            if DEBUG>2: print("Deleted {} old printed label jobs".format(len(entries)-PRINTED_KEEP))
+
+    def Find(self, key):
+        ''' the most recent job (printed or not) of the DUT with this serial number, DSK or PIN '''
+        dsk = DSKPrefix(key)
+        queued = []
+        for filename in self.Queued():
+            with open(filename) as f:
+                queued.append(json.load(f))
+        with self.lock:
+            entries = self.Index()
+        for e in queued[::-1] + entries[::-1]:     # newest first
+            if (e["serial"] is not None and str(e["serial"]).lower() == str(key).lower()) or (
+                    dsk and e["dsk"] and e["dsk"].startswith(dsk)):  # the PIN is the first 5 digits of the DSK
+                if "zpl" in e:
+                    return(e)
+                with open(os.path.join(self.printeddir, e["id"] + ".json")) as f:
+                    return(json.load(f))
+        return(None)
+
+    def Reprint(self, key):
+        ''' Queue the labels of an already tested DUT again - returns False if the DUT is not found '''
+        job = self.Find(key)
+        if job is None:
+            print("No labels found for {}".format(key))
+            return(False)
+        self.Enqueue(job["zpl"], job["qr"], job["serial"])
+        if DEBUG>2: print("Reprinting the labels of DSK {}".format(job["dsk"]))
+        return(True)
+
+    def run(self):
+        delay = RETRY_DELAY
+        while True:
+            jobs = self.Queued()
+            if len(jobs) == 0 or self.printer is None:
+                self.status = "idle"
+                self.wake.wait()
+                self.wake.clear()
+                continue
+            ready, reason = PrinterStatus(self.printer.queue)
+            if not ready:
+                self.status = "printer not ready: {}".format(reason)
+            elif (not self.needsetup or self.sendsetup()) and self.send(jobs[0]):
+                delay = RETRY_DELAY
+                continue
+            self.needsetup = self.setup is not None    # the printer may be power cycled to clear the error
+            if DEBUG>1: print("\n\r*** Label printer: {} - {} labels waiting, retry in {}s".format(self.status, len(jobs), delay), flush=True)
+            self.wake.wait(delay)
+            self.wake.clear()
+            delay = min(2*delay, RETRY_DELAY_MAX)
+
+    def sendsetup(self):
+        ''' send the setup ZPL - returns False if it failed '''
+        try:
+            self.printer.output(self.setup)
+        except Exception as err:
+            self.status = "print failed: {}".format(err)
+            return(False)
+        self.needsetup = False
+        return(True)
+
+    def send(self, filename):
+        ''' print one job and move it to printed - returns False if it failed '''
+        with open(filename) as f:
+            job = json.load(f)
+        job["attempts"] += 1
+        try:
+            self.printer.output(job["zpl"])
+        except Exception as err:
+            self.status = "print failed: {}".format(err)
+            self.write(filename, job)
+            return(False)
+        job["printed"] = time.time()
+        with self.lock:
+            self.Index()    # build the index from the job files the first time
+            self.write(os.path.join(self.printeddir, os.path.basename(filename)), job)
+            os.remove(filename)
+            with open(self.indexfile, "a") as f:
+                f.write(json.dumps({"id": job["id"], "dsk": job["dsk"], "serial": job["serial"]}) + "\n")
+        self.printed += 1
+        if self.printed % PRUNE_EVERY == 0:
+            self.Prune()
+        self.status = "printing"
+        return(True)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        spooler = PrintSpooler()
+        for filename in spooler.Queued():
+            with open(filename) as f:
+                job = json.load(f)
+            print("{} DSK={} serial={} attempts={}".format(job["id"], job["dsk"], job["serial"], job["attempts"]))
+        sys.exit(0)
+    import SmartStartQR
+    spooler = PrintSpooler(SmartStartQR.OpenPrinter(), setup=SmartStartQR.SS_LogoZPL())
+    if spooler.Reprint(sys.argv[1]):
+        spooler.start()
+        while spooler.Queued():
+            time.sleep(0.5)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+''' RailTest client for the WSTK VCOM port
+
+    RailTest answers every command with one response in braces after the echo of the command:
+
+        getctune
+        {{(getctune)}{CTUNEXIANA:0x09b}{CTUNEXOANA:0x0c3}}
+        >
+
+    RailTestParser picks the responses out of the byte stream by counting the braces so the echo, the prompt
+    and any garbage from the UART while the DUT boots are skipped. Each response becomes the name of the
+    command and a dict of the key:value pairs: ("getctune", {"CTUNEXIANA": "0x09b", "CTUNEXOANA": "0x0c3"}).
+
+    RailTestClient.commands() sends several commands in one write and matches the responses to them in order.
+    Each command has its own deadline (timeout seconds after the previous response) instead of a number of
+    readline() calls so a DUT that stops answering fails the command in a known time.
+
+    Usage: python RailTest.py <COM port> [command]... - prints the responses of the commands (default getversion)
+'''
+import re
+import sys
+import time
+import serial
+import Metrics
+
+DEBUG = 3   # print debug messages - the higher the value, the more details are printed
+
+RAILTEST_TIMEOUT = 1.0  # seconds for RailTest to answer one command
+RAILTEST_BAUD = 115200
+MAX_FRAME = 4096        # bytes - an unterminated brace in garbage is dropped after this many
+
+FIELD = re.compile(r'\{([^{}]*)\}')
+
+class RailTestError(Exception):
+    ''' RailTest did not answer in time or answered with an error '''
+    pass
+
+def ParseFrame(frame):
+    ''' {{(getctune)}{CTUNEXIANA:0x09b}} -> ("getctune", {"CTUNEXIANA": "0x09b"}) '''
+    name = None
+    values = {}
+    for field in FIELD.findall(frame):
+        if field.startswith('(') and field.endswith(')') and name is None:
+            name = field[1:-1]
+        elif ':' in field:
+            key, value = field.split(':', 1)
+            values[key.strip()] = value.strip()
+    return(name, values)
+
+class RailTestParser:
+    ''' Streaming parser - feed() it bytes as they arrive and it returns the complete responses '''
+
+    def __init__(self):
+        self.depth = 0
+        self.frame = bytearray()
+
+    def feed(self, data):
+        frames = []
+        for c in data:
+            if c == 0x7B:       # {
+                if self.depth == 0:
+                    self.frame = bytearray()
+                self.depth += 1
+            if self.depth > 0:
+                self.frame.append(c)
+                if self.frame.endswith(b"{{(") and len(self.frame) > 3:    # a response starts in the middle of garbage with a stray {
+                    self.frame = bytearray(b"{{(")
+                    self.depth = 2
+                elif c == 0x7D:   # }
+                    self.depth -= 1
+                    if self.depth == 0:
+                        name, values = ParseFrame(self.frame.decode(errors="replace"))
+                        if name is not None:
+                            frames.append((name, values))
+                elif len(self.frame) > MAX_FRAME:
+                    self.depth = 0
+        return(frames)
+
+class RailTestClient:
+    ''' RailTest commands over the serial port of the WSTK - ser is an open serial port or the name of one '''
+
+    def __init__(self, ser, timeout=RAILTEST_TIMEOUT):
+        self.ser = serial.Serial(ser, RAILTEST_BAUD) if isinstance(ser, str) else ser
+        self.timeout = timeout
+        self.parser = RailTestParser()
+
+    def command(self, cmd, timeout=None):
+        ''' send one command and return its response dict - raises RailTestError '''
+        return(self.commands([cmd], timeout)[0])
+
+    def commands(self, cmds, timeout=None):
+        ''' send the commands in one write and return the list of their response dicts in the same order.
+            Responses to anything else (IE: a command from before a timeout) are skipped.
+        '''
+        timeout = self.timeout if timeout is None else timeout
+        names = [cmd.split(' ', 1)[0].lower() for cmd in cmds]
+        self.ser.write("".join(cmd + "\n" for cmd in cmds).encode())
+        responses = []
+        start = time.time()
+        deadline = start + timeout
+        while len(responses) < len(cmds):
+            now = time.time()
+            if now >= deadline:
+                Metrics.Record("railtest", names[len(responses)], start, now-start, False)
+                raise RailTestError("no response to {} in {}s".format(cmds[len(responses)], timeout))
+            self.ser.timeout = deadline-now
+            data = self.ser.read(self.ser.in_waiting or 1)
+            for name, values in self.parser.feed(data):
+                if len(responses) < len(cmds) and name.lower() == names[len(responses)]:
+                    now = time.time()
+                    Metrics.Record("railtest", names[len(responses)], start, now-start, "Error" not in values)
+                    if DEBUG>8: print("{} -> {}".format(cmds[len(responses)], values))
+                    if "Error" in values:
+                        raise RailTestError("{} failed: {}".format(cmds[len(responses)], values["Error"]))
+                    responses.append(values)
+                    start = now
+                    deadline = now + timeout    # the next command is answered once this one is done
+                elif DEBUG>6: print("RailTest response {} {} skipped".format(name, values))
+        return(responses)
+
+    def flush(self):
+        ''' drop anything already received - IE: the boot message '''
+        self.ser.reset_input_buffer()
+        self.parser = RailTestParser()
+
+    def close(self):
+        self.ser.close()
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python RailTest.py <COM port> [command]...")
+        sys.exit(1)
+    rail = RailTestClient(sys.argv[1])
+    cmds = sys.argv[2:] or ["getversion"]
+    for cmd, values in zip(cmds, rail.commands(cmds)):
+        print("{}: {}".format(cmd, values))
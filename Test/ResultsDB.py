@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+''' Production results database for the ZRAD test station
+
+    Every DUT tested is stored in a local SQLite file (RESULTS_DB) with the jig, WSTK serial number,
+    DSK and QR code, pass/fail and the failing step, SE version, CTUNE and calibration trials,
+    the measured current, the carrier power, noise floor and spurs from the calibration sweeps
+    and the time of every pipeline step.
+    The DUTs are written by a background thread in batches so a slow disk never adds to the cycle time.
+    The table is indexed on the time, WSTK, DSK, unique ID and failing step so months of production can be queried quickly.
+
+    Usage: python ResultsDB.py yield [--by day|week|month] [--since 2026-01-01] [--until 2026-02-01]
+           python ResultsDB.py pareto [--since DATE] [--until DATE]   - failures by step
+           python ResultsDB.py history <DSK, PIN, unique ID or WSTK serial number>
+'''
+import json
+import time
+import queue
+import sqlite3
+import argparse
+import threading
+from datetime import datetime
+from contextlib import closing
+
+DEBUG = 3   # print debug messages - the higher the value, the more details are printed
+
+RESULTS_DB = "results.db"
+BATCH_SIZE = 20         # DUTs written in one transaction
+BATCH_SECONDS = 5       # longest a DUT waits in memory before it is written
+
+COLUMNS = ["time", "jig", "wstkser", "uid", "dsk", "qr", "passed", "fail_step", "se_version", "ctune", "trials", "current",
+           "tx_power", "noise_floor", "spur_dbc", "duration", "steps"]
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,     -- start of the test, seconds since 1970
+    jig TEXT,
+    wstkser TEXT,
+    uid TEXT,               -- EFR32 unique ID if known
+    dsk TEXT,               -- 40 digits
+    qr TEXT,
+    passed INTEGER NOT NULL,
+    fail_step TEXT,         -- NULL if passed
+    se_version TEXT,
+    ctune INTEGER,
+    trials INTEGER,         -- calibration trials - 0 if the CTUNE was already set
+    current REAL,           -- mA
+    tx_power REAL,          -- dBm of the carrier at the TinySA - NULL if not swept
+    noise_floor REAL,       -- dBm
+    spur_dbc REAL,          -- highest spur relative to the carrier
+    duration REAL,          -- seconds
+    steps TEXT              -- JSON {step: seconds}
+);
+CREATE INDEX IF NOT EXISTS results_time ON results(time);
+CREATE INDEX IF NOT EXISTS results_wstkser ON results(wstkser);
+CREATE INDEX IF NOT EXISTS results_dsk ON results(dsk);
+CREATE INDEX IF NOT EXISTS results_uid ON results(uid);
+CREATE INDEX IF NOT EXISTS results_fail_step ON results(fail_step, time);
+'''
+
+PERIODS = {"day": "%Y-%m-%d", "week": "%Y-W%W", "month": "%Y-%m"}
+
+def Connect(filename=RESULTS_DB):
+    db = sqlite3.connect(filename, timeout=30)
+    db.execute("PRAGMA journal_mode=WAL")       # queries can run while the station is writing
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.executescript(SCHEMA)
+    return(db)
+
+def ParseDate(text):
+    ''' YYYY-MM-DD or YYYY-MM to seconds since 1970 - None stays None '''
+    if text is None:
+        return(None)
+    for fmt in ("%Y-%m-%d", "%Y-%m"):
+        try:
+            return(datetime.strptime(text, fmt).timestamp())
+        except ValueError:
+            pass
+    raise ValueError("{} is not a date like 2026-01-31".format(text))
+
+class ResultsDB:
+    ''' The station results - Add() returns immediately and a background thread writes the DUTs in batches '''
+
+    def __init__(self, filename=RESULTS_DB):
+        self.filename = filename
+        Connect(filename).close()   # create the tables before the station starts
+        self.pending = queue.Queue()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return(self)
+
+    def Add(self, result):
+        ''' queue one DUT - result is a dict with any of the COLUMNS, steps is a dict of {step: seconds} '''
+        row = [result.get(col) for col in COLUMNS]
+        row[COLUMNS.index("passed")] = 1 if result.get("passed") else 0
+        row[COLUMNS.index("steps")] = json.dumps(result.get("steps", {}))
+        self.pending.put(row)
+
+    def run(self):
+        db = Connect(self.filename)
+        insert = "INSERT INTO results ({}) VALUES ({})".format(",".join(COLUMNS), ",".join("?"*len(COLUMNS)))
+        stop = False
+        while not stop:
+            batch = []
+            row = self.pending.get()
+            deadline = time.time() + BATCH_SECONDS
+            while True:
+                if row is None:     # close()
+                    stop = True
+                    break
+                batch.append(row)
+                if len(batch) >= BATCH_SIZE:
+                    break
+                try:
+                    row = self.pending.get(timeout=max(0, deadline-time.time()))
+                except queue.Empty:
+                    break
+            if batch:
+                with db:
+                    db.executemany(insert, batch)
+                if DEBUG>6: print("{} results saved".format(len(batch)))
+        db.close()
+
+    def close(self):
+        ''' write anything still queued and stop the writer '''
+        if self.thread:
+            self.pending.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def Yield(self, since=None, until=None, by="day"):
+        ''' [(period, tested, good, yield %)] '''
+        where, args = Where(since, until)
+        sql = ("SELECT strftime('{}', time, 'unixepoch', 'localtime') AS period, COUNT(*), SUM(passed) FROM results {} "
+               "GROUP BY period ORDER BY period").format(PERIODS[by], where)
+        with closing(Connect(self.filename)) as db:
+            return([(period, tested, good, 100*good/tested) for period, tested, good in db.execute(sql, args)])
+
+    def Pareto(self, since=None, until=None):
+        ''' [(fail_step, failures, % of failures)] most common first '''
+        where, args = Where(since, until, "passed = 0")
+        sql = "SELECT fail_step, COUNT(*) AS n FROM results {} GROUP BY fail_step ORDER BY n DESC".format(where)
+        with closing(Connect(self.filename)) as db:
+            rows = db.execute(sql, args).fetchall()
+        total = sum(n for step, n in rows)
+        return([(step, n, 100*n/total) for step, n in rows])
+
+    def History(self, key):
+        ''' every test of the DUT (DSK, PIN or unique ID) or of the WSTK (serial number) - newest first '''
+        digits = key.strip().replace("-", "")   # DSKs are printed as 44383-12478-...
+        sql = ("SELECT * FROM results WHERE uid = ? OR wstkser = ? OR (dsk >= ? AND dsk < ?) ORDER BY time DESC")
+        # only a PIN (the first 5 digits of the DSK) or a DSK is looked up by its prefix - never a unique ID or serial number
+        prefix = digits if len(digits) >= 5 and digits.isdigit() else "-"
+        with closing(Connect(self.filename)) as db:
+            db.row_factory = sqlite3.Row
+            return([dict(row) for row in db.execute(sql, (key, key, prefix, prefix + ":"))])   # ':' sorts after '9'
+
+    def Report(self, since=None, until=None):
+        ''' yield and failure pareto as a string '''
+        out = []
+        rows = self.Yield(since, until, "month")
+        tested = sum(r[1] for r in rows)
+        good = sum(r[2] for r in rows)
+        if tested == 0:
+            return("No DUTs tested")
+        out.append("{} DUTs tested, {} good = {:.1f}% yield".format(tested, good, 100*good/tested))
+        for step, n, pct in self.Pareto(since, until):
+            out.append("  {:24} {:6} failures {:5.1f}%".format(str(step), n, pct))
+        return("\n".join(out))
+
+def Where(since, until, *conditions):
+    ''' WHERE clause on the time index '''
+    conditions = list(conditions)
+    args = []
+    if since is not None:
+        conditions.append("time >= ?")
+        args.append(since)
+    if until is not None:
+        conditions.append("time < ?")
+        args.append(until)
+    return(("WHERE " + " AND ".join(conditions)) if conditions else "", args)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ZRAD test station production results")
+    parser.add_argument("query", choices=["yield", "pareto", "history"])
+    parser.add_argument("key", nargs="?", help="history: DSK, PIN, unique ID or WSTK serial number")
+    parser.add_argument("-d", "--db", default=RESULTS_DB, help="results database file")
+    parser.add_argument("--since", help="first date to include - 2026-01-31 or 2026-01")
+    parser.add_argument("--until", help="first date NOT included")
+    parser.add_argument("--by", choices=sorted(PERIODS), default="day", help="yield: period to group by")
+    args = parser.parse_args()
+
+    results = ResultsDB(args.db)
+    since, until = ParseDate(args.since), ParseDate(args.until)
+    if args.query == "yield":
+        print("{:10} {:>8} {:>8} {:>7}".format(args.by, "tested", "good", "yield"))
+        for period, tested, good, pct in results.Yield(since, until, args.by):
+            print("{:10} {:8} {:8} {:6.1f}%".format(period, tested, good, pct))
+    elif args.query == "pareto":
+        print(results.Report(since, until))
+    else:
+        if args.key is None:
+            parser.error("history needs a DSK, PIN, unique ID or WSTK serial number")
+        for r in results.History(args.key):
+            print("{} {} WSTK={} DSK={} {} SE={} CTUNE={} trials={} {}mA TX={}dBm spur={}dBc {:.1f}s".format(
+                datetime.fromtimestamp(r["time"]).strftime("%Y-%m-%d %H:%M:%S"), r["jig"], r["wstkser"], r["dsk"],
+                "PASSED" if r["passed"] else "FAILED at " + str(r["fail_step"]), r["se_version"], r["ctune"], r["trials"], r["current"],
+                r["tx_power"] if r["tx_power"] is None else round(r["tx_power"], 1), r["spur_dbc"] if r["spur_dbc"] is None else round(r["spur_dbc"], 1), r["duration"]))
@@ -0,0 +1,491 @@
+#!/usr/bin/env python3
+''' Simulated test station instruments for running and profiling ZRADCalProgTest without any hardware
+
+    SimDUT              - a ZRADmini with a crystal whose carrier frequency depends on CTUNE
+    RailTestEmulator    - RailTest on the DUT answering on a pseudo terminal like the WSTK VCOM port
+    TinySAEmulator      - TinySA answering on a pseudo terminal, sees the carrier of every DUT with the tone on
+    FakeCommander       - the Commander.Commander methods with configurable step timings
+
+    The emulators use Linux/macOS pseudo terminals (pty) so the real pyserial based code talks to them unchanged.
+
+    Usage: python Simulator.py [-j JIGS] [-n DUTS] [-s SPEED] [-a ANALYZERS]
+           python Simulator.py -t   - regression checks of the station on the simulated instruments
+    Runs DUTS boards through each of JIGS simulated jigs and prints the station throughput.
+    With more than one TinySA the jigs are split into groups that each hear only their own TinySA.
+    SPEED divides every simulated delay and the fixed waits of the station (POLL_INTERVAL, UART_SETTLE, PAIR_WAIT)
+    so the station logic can be profiled quickly:
+        python -m cProfile -s cumtime Simulator.py -j 4 -n 5 -s 10
+    The host processing time is not sped up but the report still multiplies every time by SPEED, so only -s 1 gives
+    representative step timings and throughput.
+'''
+import os
+import sys
+import tty
+import time
+import math
+import random
+import struct
+import hashlib
+import threading
+import argparse
+
+DEBUG = 3   # print debug messages - the higher the value, the more details are printed
+
+# Z-Wave US region channels in RailTest
+CHANNEL_FREQ = {0: 916000000, 1: 908400000, 2: 908420000}
+
+SLOPE = -1500           # Hz per CTUNE step of the simulated crystals
+INTERCEPT_MEAN = 150    # CTUNE that puts a typical crystal on frequency
+INTERCEPT_SIGMA = 8     # board to board crystal variation in CTUNE steps
+DEFAULT_CTUNE = 0x9b    # CTUNE value of a fresh chip
+
+TONE_LEVEL = -8.0       # dBm of the carrier at the TinySA
+NOISE_FLOOR = -95.0     # dBm
+NOISE_SIGMA = 1.5       # dB of noise on every point
+LEVEL_JITTER = 1.0      # dB of level jitter on every point including the carrier - the real TinySA is 0.5-1dB
+FREQ_JITTER = 100       # Hz of carrier jitter between sweeps
+SA_POINT_TIME = 0.010   # seconds per sweep point at RBW 1kHz - 145 points is the usual 1.5s sweep
+
+# seconds for each Commander operation
+COMMANDER_TIMES = {
+    "SecurityStatus": 1.0,
+    "SecurityLock": 1.0,
+    "CtuneGet": 0.8,
+    "CtuneSet": 0.8,
+    "FlashSE": 8.0,
+    "FlashRailTest": 3.0,
+    "Flash": 6.0,
+    "AemMeasure": 1.5,
+    "ZwaveQRCode": 1.0,
+    "UniqueID": 0.5,
+    "Verify": 2.0,
+    "DeviceReset": 0.5,
+    "DeviceUnlock": 2.0,
+    "PageErase": 0.8,
+    }
+
+OPERATOR_LOAD_TIME = 5.0    # seconds for the operator to swap the DUT in a jig
+
+def SmartStartString(dsk=None):
+    ''' a SmartStart QR code string with a valid checksum - random DSK if none is given '''
+    if dsk is None:
+        dsk = "".join("{:05d}".format(random.randrange(65536)) for i in range(8))
+    body = "131" + dsk + "0010" + "08193" + "03079" + "0220" + "00012" + "00516" + "00002" + "02580" + "0803001"
+    checksum = int.from_bytes(hashlib.sha1(body.encode()).digest()[:2], "big")
+    return "9001{:05d}".format(checksum) + body
+
+class SimDUT:
+    ''' A simulated ZRADmini in a jig '''
+
+    def __init__(self, intercept=None, se_version="2.2.6"):
+        self.intercept = intercept if intercept is not None else random.gauss(INTERCEPT_MEAN, INTERCEPT_SIGMA)
+        self.ctune = DEFAULT_CTUNE
+        self.ctune_token = None
+        self.se_version = se_version
+        self.locked = False
+        self.firmware = None    # None, "railtest" or "app"
+        self.channel = 2
+        self.tone = False
+        self.offset = 0         # Hz
+        self.qr = SmartStartString()
+        self.uid = "{:016x}".format(random.getrandbits(64))
+        self.lock = threading.Lock()
+
+    def carrier(self):
+        ''' frequency of the carrier in Hz '''
+        nominal = CHANNEL_FREQ.get(self.channel, CHANNEL_FREQ[2])
+        return nominal + self.offset + SLOPE*(nominal/CHANNEL_FREQ[2])*(self.ctune-self.intercept)
+
+    def boot(self):
+        if self.ctune_token is not None:
+            self.ctune = self.ctune_token
+        self.tone = False
+
+class PtyDevice:
+    ''' A serial device emulated on a pseudo terminal - port is the name to open with pyserial '''
+
+    def __init__(self, eol):
+        self.master, slave = os.openpty()
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        self.slave = slave      # keep it open so the pty stays valid between opens
+        self.eol = eol
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        os.write(self.master, data)
+
+    def _run(self):
+        line = b''
+        while self.running:
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                return
+            for c in data:
+                c = bytes([c])
+                if c in self.eol:
+                    self.command(line.decode(errors="replace").strip())
+                    line = b''
+                else:
+                    line += c
+
+    def close(self):
+        self.running = False
+        os.close(self.master)
+        os.close(self.slave)
+
+class RailTestEmulator(PtyDevice):
+    ''' RailTest on a SimDUT - answers the commands ZG23CrystalCal uses in the {{(cmd)}{key:val}} format '''
+
+    def __init__(self, dut, speed=1.0):
+        self.dut = dut
+        self.speed = speed
+        super().__init__(eol=(b'\n', b'\r'))
+
+    def command(self, cmd):
+        if len(cmd) == 0:
+            self.write("\r\n> ")
+            return
+        words = cmd.split()
+        name = words[0]
+        dut = self.dut
+        with dut.lock:
+            if name == "getversion":
+                rsp = "{App:Rail Test App}{Built:Simulator}{RAIL:2.15.0}"
+            elif name == "getctune":
+                rsp = "{{CTUNEXIANA:0x{:03x}}}{{CTUNEXOANA:0x{:03x}}}".format(dut.ctune, dut.ctune)
+            elif name == "setctune" and len(words) > 1:
+                dut.ctune = int(words[1], 0)
+                rsp = "{{CTUNEXIANA:0x{:03x}}}{{CTUNEXOANA:0x{:03x}}}".format(dut.ctune, dut.ctune)
+            elif name == "rx":
+                rsp = "{Rx:Disabled}{Idle:Enabled}"
+            elif name == "setzwavemode":
+                rsp = "{ZWaveMode:Enabled}"
+            elif name == "setzwaveregion":
+                rsp = "{ZWaveRegion:US}"
+            elif name == "setchannel" and len(words) > 1:
+                dut.channel = int(words[1])
+                rsp = "{{channel:{}}}".format(dut.channel)
+            elif name.lower() == "settxtone" and len(words) > 1:
+                dut.tone = words[1] == "1"
+                rsp = "{{{}:{}}}".format(name, "Enabled" if dut.tone else "Disabled")
+            else:
+                rsp = "{Error:Unknown command}"
+        time.sleep(0.002/self.speed)
+        self.write("{}\r\n{{{{({})}}{}}}\r\n> ".format(cmd, name, rsp))
+
+class TinySAEmulator(PtyDevice):
+    ''' TinySA that sees the carrier of every DUT in duts with the tone turned on '''
+
+    def __init__(self, duts, speed=1.0, serial_number="400"):
+        self.duts = duts
+        self.speed = speed
+        self.serial_number = serial_number
+        self.rbw = 1.0      # kHz
+        self.start, self.stop = 1e6, 350e6
+        self.freqs = []
+        self.levels = []
+        super().__init__(eol=(b'\r', b'\n'))
+
+    def level(self, f, carriers):
+        ''' dBm at frequency f - every carrier is shaped by the RBW filter with -3dB at +/-RBW/2 '''
+        bw = self.rbw*1000
+        p = 10**((NOISE_FLOOR + random.gauss(0, NOISE_SIGMA))/10)
+        for fc in carriers:
+            p += 10**((TONE_LEVEL - 12*((f-fc)/bw)**2)/10)
+        return 10*math.log10(p) + random.gauss(0, LEVEL_JITTER)
+
+    def sweep(self, start, stop, points):
+        time.sleep(points*SA_POINT_TIME/self.rbw/self.speed)
+        carriers = []
+        for dut in self.duts:
+            with dut.lock:
+                if dut.tone:
+                    carriers.append(dut.carrier() + random.gauss(0, FREQ_JITTER))
+        self.freqs = [start + (stop-start)*i/(points-1) for i in range(points)] if points > 1 else [start]
+        self.levels = [self.level(f, carriers) for f in self.freqs]
+
+    def command(self, cmd):
+        if len(cmd) == 0:
+            self.write("ch> ")
+            return
+        self.write(cmd + "\r\n")
+        words = cmd.split()
+        out = ""
+        if words[0] == "rbw" and len(words) > 1:
+            self.rbw = 1.0 if words[1] == "auto" else float(words[1])
+        elif words[0] == "sweep" and len(words) > 2:
+            if words[1] == "start":
+                self.start = float(words[2])
+            elif words[1] == "stop":
+                self.stop = float(words[2])
+        elif words[0] == "scan" and len(words) > 2:
+            self.sweep(float(words[1]), float(words[2]), int(words[3]) if len(words) > 3 else 290)
+        elif words[0] == "scanraw" and len(words) > 2:
+            points = int(words[3]) if len(words) > 3 else 290
+            self.sweep(float(words[1]), float(words[2]), points)
+            raw = b''.join(b'x' + struct.pack('<H', max(0, min(65535, int((l+128)*32)))) for l in self.levels)
+            self.write(b'{' + raw + b'}')
+        elif words[0] == "marker":
+            if self.levels:
+                i = max(range(len(self.levels)), key=lambda i: self.levels[i])
+                out = "1 {} {:d} {:.2e}\r\n".format(i, int(self.freqs[i]), self.levels[i])
+        elif words[0] == "data":
+            out = "".join("{:e}\r\n".format(l) for l in self.levels)
+        elif words[0] == "frequencies":
+            out = "".join("{:d}\r\n".format(int(f)) for f in self.freqs)
+        elif words[0] == "hop" and len(words) > 1:
+            self.sweep(float(words[1]), float(words[1]), 1)
+            out = "{:e}\r\n".format(self.levels[0])
+        elif words[0] == "k":
+            out = "35.0\r\n"
+        self.write(out + "ch> ")
+
+class FakeCommander:
+    ''' Commander.Commander for a SimDUT - every operation takes the time listed in COMMANDER_TIMES '''
+
+    def __init__(self, wstkser, dut, speed=1.0, times=COMMANDER_TIMES):
+        self.wstkser = wstkser
+        self.dut = dut
+        self.speed = speed
+        self.times = times
+
+    def wait(self, op):
+        import Metrics
+        with Metrics.Timer("commander", op):
+            time.sleep(self.times.get(op, 1.0)/self.speed)
+
+    def SecurityStatus(self):
+        import Commander
+        self.wait("SecurityStatus")
+        return Commander.SecurityStatus(self.dut.se_version, self.dut.locked)
+
+    def SecurityLock(self):
+        self.wait("SecurityLock")
+        self.dut.locked = True
+        return "Device is now locked"
+
+    def CtuneGet(self):
+        self.wait("CtuneGet")
+        return self.dut.ctune_token
+
+    def CtuneSet(self, value):
+        self.wait("CtuneSet")
+        self.dut.ctune_token = int(value)
+        return "DONE"
+
+    def Flash(self, filename, masserase=False):
+        name = os.path.basename(filename).lower()
+        if name.startswith("s2c3_se"):
+            self.wait("FlashSE")
+            self.dut.se_version = name.split("_")[-1].split(".")[0].replace("v", ".").replace("p", ".")
+            self.dut.firmware = None
+        elif "railtest" in name:
+            self.wait("FlashRailTest")
+            self.dut.firmware = "railtest"
+        else:
+            self.wait("Flash")
+            self.dut.firmware = "app"
+        self.dut.boot()
+        return True
+
+    def AemMeasure(self, windowlength=200):
+        self.wait("AemMeasure")
+        return random.gauss(7.0, 0.3) if self.dut.firmware == "app" else random.gauss(3.0, 0.3)
+
+    def ZwaveQRCode(self, timeout=1000):
+        self.wait("ZwaveQRCode")
+        return self.dut.qr if self.dut.firmware == "app" else ""
+
+    def UniqueID(self):
+        self.wait("UniqueID")
+        return self.dut.uid
+
+    def Verify(self, filename):
+        self.wait("Verify")
+        return self.dut.firmware == "app"
+
+    def DeviceReset(self):
+        self.wait("DeviceReset")
+        self.dut.boot()
+        return "DONE"
+
+    def DeviceUnlock(self):
+        self.wait("DeviceUnlock")
+        self.dut.locked = False
+        self.dut.firmware = None
+        return "DONE"
+
+    def PageErase(self, region):
+        self.wait("PageErase")
+        if region == "@userdata":
+            self.dut.ctune_token = None
+        return "DONE"
+
+class SimJig:
+    ''' The instruments of one simulated jig - insert() swaps in the next DUT '''
+
+    def __init__(self, idx, tinysa, speed=1.0):
+        self.dut = SimDUT()
+        self.railtest = RailTestEmulator(self.dut, speed)
+        self.cmdr = FakeCommander("SIM{}".format(idx+1), self.dut, speed)
+        self.tinysa = tinysa
+        tinysa.duts.append(self.dut)
+        self.config = {"name": "SIM{}".format(idx+1), "com": self.railtest.port, "ser": self.cmdr.wstkser, "arrow": ">"}
+
+    def insert(self, dut=None):
+        old = self.dut
+        self.dut = dut or SimDUT(se_version=random.choice(["2.2.6", "2.2.6", "2.1.7"]))
+        self.railtest.dut = self.dut
+        self.cmdr.dut = self.dut
+        self.tinysa.duts[self.tinysa.duts.index(old)] = self.dut
+
+def SimStation(jigs=2, speed=1.0, analyzers=1):
+    ''' Build a simulated station and point Commander and ZG23CrystalCal at it - returns the station config and the SimJigs '''
+    import Commander
+    import Station
+    import ZG23CrystalCal
+    import ZRADCalProgTest
+    tinysas = [TinySAEmulator([], speed, str(400+i)) for i in range(analyzers)]
+    simjigs = [SimJig(i, tinysas[i*analyzers//jigs], speed) for i in range(jigs)]   # consecutive jigs share a TinySA
+    for sj in simjigs:
+        Commander.SetCommander(sj.cmdr.wstkser, sj.cmdr)
+    ZG23CrystalCal.TINYSA_PORT = tinysas[0].port
+    ZG23CrystalCal.PAIR_WAIT /= speed   # the other jig arrives speed times sooner too
+    ZG23CrystalCal.UART_SETTLE /= speed # the fixed waits of the station are sped up like the instruments
+    ZRADCalProgTest.POLL_INTERVAL /= speed
+    station = {"jigs": [sj.config for sj in simjigs], "resources": dict(Station.DEFAULT_RESOURCES),
+               "analyzers": [{"serial": t.serial_number, "port": t.port, "jigs": [sj.config["name"] for sj in simjigs if sj.tinysa is t]} for t in tinysas]}
+    return station, simjigs
+
+def SimTesters(station, labels=False):
+    ''' a ZRADCalProgTest for every jig of the station sharing one scheduler and AnalyzerPool '''
+    import Station
+    import ZRADCalProgTest
+    import ZG23CrystalCal
+    if not labels:  # no printer in the simulator
+        ZRADCalProgTest.PIPELINE = [step for step in ZRADCalProgTest.PIPELINE if step[0] != "PrintLabels"]
+    sched = Station.ResourceScheduler(station["resources"])
+    testers = [ZRADCalProgTest.ZRADCalProgTest(jig, sched, idx) for idx, jig in enumerate(station["jigs"])]
+    pool = ZG23CrystalCal.AnalyzerPool(station["analyzers"])
+    for tester in testers:
+        tester.analyzers = pool
+    return(testers)
+
+def Check(name, passed):
+    ''' print the result of one SelfTest check '''
+    print("{} {}".format("PASS" if passed else "FAIL", name), flush=True)
+    return(passed)
+
+def CheckBadPort(speed):
+    ''' a step that can't open its WSTK port fails the DUT instead of leaving TestDUT waiting forever '''
+    station, simjigs = SimStation(1, speed)
+    station["jigs"][0]["com"] = "/dev/nonexistent-wstk"
+    tester = SimTesters(station)[0]
+    result = []
+    t = threading.Thread(target=lambda: result.append(tester.TestDUT()), daemon=True)
+    t.start()
+    t.join(60)
+    return(Check("a jig with a bad WSTK port fails the DUT", not t.is_alive() and result == [False]))
+
+def CheckLeases():
+    ''' the AnalyzerPool lease rules - RF isolation comes only from the jigs lists of the station configuration.
+        Returns the list of the results of the checks.
+    '''
+    import ZG23CrystalCal
+
+    def concurrent(analyzers, jigs):
+        ''' True if jigs[1] gets an analyzer while jigs[0] holds one '''
+        pool = ZG23CrystalCal.AnalyzerPool(analyzers)
+        holding = threading.Event()
+        release = threading.Event()
+        got = threading.Event()
+        def first():
+            with pool.Lease(jigs[0]):
+                holding.set()
+                release.wait(5)
+        def second():
+            holding.wait(5)
+            with pool.Lease(jigs[1]):
+                got.set()
+        threads = [threading.Thread(target=first, daemon=True), threading.Thread(target=second, daemon=True)]
+        for t in threads:
+            t.start()
+        both = got.wait(1)
+        release.set()
+        for t in threads:
+            t.join(5)
+        return(both and not any(t.is_alive() for t in threads))
+
+    pool = ZG23CrystalCal.AnalyzerPool([{"port": "A", "jigs": ["L"]}])
+    try:
+        with pool.Lease("R"):
+            refused = False
+    except OSError:
+        refused = True
+    return([
+        Check("analyzers without jigs lists are leased one at a time",
+            not concurrent([{"port": "A"}, {"port": "B"}], ["L", "R"])),
+        Check("analyzers with their own jigs are leased at the same time",
+            concurrent([{"port": "A", "jigs": ["L"]}, {"port": "B", "jigs": ["R"]}], ["L", "R"])),
+        Check("an analyzer without a jigs list waits for an isolated one",
+            not concurrent([{"port": "A", "jigs": ["L"]}, {"port": "B"}], ["L", "R"])),
+        Check("a jig no analyzer can measure is refused", refused),
+        ])
+
+def SelfTest(speed=20.0):
+    ''' Regression checks of the station run on the simulated instruments - returns True if they all pass '''
+    checks = [CheckBadPort(speed)] + CheckLeases()
+    print("{} of {} checks passed".format(sum(checks), len(checks)))
+    return(all(checks))
+
+def Benchmark(jigs=2, duts=5, speed=1.0, labels=False, analyzers=1, pairing=False):
+    ''' Run duts boards through every jig like an operator would and print the throughput '''
+    import Station
+    import Metrics
+    import ZRADCalProgTest
+    import ZG23CrystalCal
+    station, simjigs = SimStation(jigs, speed, analyzers)
+    ZG23CrystalCal.CAL_PAIRING = pairing
+    testers = SimTesters(station, labels)
+    results = [[] for t in testers]
+
+    def operator(idx):
+        for n in range(duts):
+            simjigs[idx].insert()
+            time.sleep(OPERATOR_LOAD_TIME/speed)
+            start = time.time()
+            results[idx].append((testers[idx].TestDUT(), time.time()-start))
+
+    start = time.time()
+    threads = [threading.Thread(target=operator, args=(idx,)) for idx in range(len(testers))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = (time.time()-start)*speed     # in simulated seconds
+    tested = sum(len(r) for r in results)
+    good = sum(1 for r in results for ok, t in r if ok)
+    print("\n{} jigs, {} DUTs, {} good in {:.1f} simulated seconds = {:.0f} units per hour".format(
+        len(testers), tested, good, elapsed, 3600*tested/elapsed))
+    for idx, r in enumerate(results):
+        print("{}: average {:.1f}s per DUT".format(testers[idx].name, speed*sum(t for ok, t in r)/len(r)))
+    print(Metrics.Report(timescale=speed))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the ZRAD test station against simulated instruments")
+    parser.add_argument("-j", "--jigs", type=int, default=2, help="number of jigs")
+    parser.add_argument("-n", "--duts", type=int, default=5, help="DUTs tested in each jig")
+    parser.add_argument("-s", "--speed", type=float, default=1.0, help="divide every simulated delay by this")
+    parser.add_argument("-a", "--analyzers", type=int, default=1, help="number of TinySAs")
+    parser.add_argument("-p", "--pair", action="store_true", help="calibrate 2 DUTs together when they can (CAL_PAIRING)")
+    parser.add_argument("-t", "--test", action="store_true", help="run the regression checks instead of the benchmark")
+    args = parser.parse_args()
+    if args.test:
+        sys.exit(0 if SelfTest() else 1)
+    Benchmark(args.jigs, args.duts, args.speed, analyzers=args.analyzers, pairing=args.pair)
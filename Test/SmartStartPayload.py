@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+''' Z-Wave SmartStart QR code payload parser and validator
+
+    Parses the decimal digit string computed by the DUT (commander device zwave-qrcode) into its fields
+    and verifies the checksum before the labels are printed. See the SmartStartQR.py docstring and
+    Silabs SDS13937 "Node Provisioning QR Code Format" for the layout:
+
+    90 01 CCCCC KKK DDDDDx8 [TT LL VALUE]...
+
+    Each TLV starts with 2 digits holding the type shifted left by 1 with the critical flag in bit 0,
+    then 2 digits with the number of digits in the value. IE: 0010 = type 0 (Product Type) with
+    10 digits, 0220 = type 1 (Product ID) with 20 digits, 0803 = type 4 (Supported Protocols) with 3.
+
+    The bulk mode validates a whole production log (one QR code per line) to find corrupted payloads
+    and DSKs that were programmed into more than one DUT.
+
+    Usage: python SmartStartPayload.py <QR code>  - prints the fields
+           python SmartStartPayload.py -b FILE    - validates every QR code in FILE (- for stdin)
+           python SmartStartPayload.py -t         - self test of the bulk validation
+'''
+import sys
+import argparse
+import hashlib
+from collections import namedtuple, defaultdict
+import numpy as np
+
+DEBUG = 3   # print debug messages - the higher the value, the more details are printed
+
+LEAD_IN = "90"          # ASCII 'Z'
+VERSION_SMARTSTART = 1  # 0 is S2 only which the station does not support
+MIN_LENGTH = 52         # lead-in, version, checksum, keys and DSK - the TLVs follow
+
+# TLV types - SDS13937
+TLV_NAMES = {
+    0: "ProductType",
+    1: "ProductID",
+    2: "MaxInclusionRequestInterval",
+    3: "UUID16",
+    4: "SupportedProtocols",
+    50: "Name",
+    51: "Location",
+    52: "SmartStartInclusionSetting",
+    53: "AdvancedJoining",
+    54: "BootstrappingMode",
+    55: "NetworkStatus",
+    }
+
+# Requested keys bits
+KEY_NAMES = {0x01: "S2 Unauthenticated", 0x02: "S2 Authenticated", 0x04: "S2 Access Control", 0x80: "S0"}
+
+TLV = namedtuple("TLV", ["type", "critical", "value"])
+ProductType = namedtuple("ProductType", ["generic_class", "specific_class", "installer_icon"])
+ProductID = namedtuple("ProductID", ["manufacturer_id", "product_type", "product_id", "app_version"])
+
+class PayloadError(ValueError):
+    ''' The QR code string is not a valid SmartStart payload '''
+    pass
+
+def Checksum(body):
+    ''' The first 2 bytes of the SHA-1 hash of the digits after the checksum field '''
+    return(int.from_bytes(hashlib.sha1(body.encode("ascii")).digest()[:2], "big"))
+
+def Word(digits):
+    ''' 5 decimal digits holding 2 bytes '''
+    value = int(digits)
+    if value > 0xFFFF:
+        raise PayloadError("{} is not a 16 bit value".format(digits))
+    return(value)
+
+class SmartStartPayload:
+    ''' The fields of one SmartStart QR code - use Parse() to create it '''
+
+    def __init__(self, qr, version, checksum, keys, dsk, tlvs):
+        self.qr = qr
+        self.version = version
+        self.checksum = checksum
+        self.keys = keys            # requested keys bitmask - see KEY_NAMES
+        self.dsk = dsk              # 40 digits
+        self.tlvs = tlvs            # list of TLV in the order in the QR code
+
+    @property
+    def pin(self):
+        ''' the first 5 digits of the DSK which are printed on the product label '''
+        return(self.dsk[:5])
+
+    @property
+    def dsk_text(self):
+        ''' the DSK the way it is printed: 44383-12478-... '''
+        return("-".join(self.dsk[i:i+5] for i in range(0, 40, 5)))
+
+    @property
+    def dsk_bytes(self):
+        return(b"".join(Word(self.dsk[i:i+5]).to_bytes(2, "big") for i in range(0, 40, 5)))
+
+    def tlv(self, tlvtype):
+        ''' the value digits of the first TLV of this type or None '''
+        for t in self.tlvs:
+            if t.type == tlvtype:
+                return(t.value)
+        return(None)
+
+    @property
+    def product_type(self):
+        value = self.tlv(0)
+        if value is None:
+            return(None)
+        devtype = Word(value[0:5])
+        return(ProductType(devtype >> 8, devtype & 0xFF, Word(value[5:10])))
+
+    @property
+    def product_id(self):
+        value = self.tlv(1)
+        if value is None:
+            return(None)
+        appver = Word(value[15:20])
+        return(ProductID(Word(value[0:5]), Word(value[5:10]), Word(value[10:15]), "{}.{}".format(appver >> 8, appver & 0xFF)))
+
+    def __str__(self):
+        out = ["DSK={} PIN={} Keys=0x{:02X} ({})".format(self.dsk_text, self.pin, self.keys,
+            ", ".join(name for bit, name in KEY_NAMES.items() if self.keys & bit))]
+        if self.product_type:
+            out.append("{}".format(self.product_type))
+        if self.product_id:
+            out.append("ManufacturerID=0x{0.manufacturer_id:04X} ProductType=0x{0.product_type:04X} ProductID=0x{0.product_id:04X} Version={0.app_version}".format(self.product_id))
+        for t in self.tlvs:
+            if t.type not in (0, 1):
+                out.append("{}{}={}".format(TLV_NAMES.get(t.type, "TLV{}".format(t.type)), "(critical)" if t.critical else "", t.value))
+        return("\n".join(out))
+
+def Parse(qr):
+    ''' Returns the SmartStartPayload of the QR code string - raises PayloadError if it is not valid '''
+    qr = qr.strip()
+    if not qr.isdigit() or not qr.isascii():
+        raise PayloadError("QR code must only have the digits 0-9: {}".format(qr))
+    if len(qr) < MIN_LENGTH:
+        raise PayloadError("QR code is only {} digits".format(len(qr)))
+    if qr[0:2] != LEAD_IN:
+        raise PayloadError("QR code does not start with {}".format(LEAD_IN))
+    version = int(qr[2:4])
+    if version != VERSION_SMARTSTART:
+        raise PayloadError("QR code version {} is not SmartStart".format(version))
+    checksum = int(qr[4:9])
+    if checksum != Checksum(qr[9:]):
+        raise PayloadError("QR code checksum {:05d} does not match {:05d}".format(checksum, Checksum(qr[9:])))
+    return(ParseFields(qr))
+
+def ParseFields(qr):
+    ''' The fields after the checksum of a QR code with a valid lead-in, version and checksum - see Parse '''
+    keys = int(qr[9:12])
+    dsk = qr[12:52]
+    for i in range(0, 40, 5):
+        Word(dsk[i:i+5])
+    tlvs = []
+    pos = MIN_LENGTH
+    while pos < len(qr):
+        if pos+4 > len(qr):
+            raise PayloadError("QR code TLV at digit {} is truncated".format(pos))
+        typecrit = int(qr[pos:pos+2])
+        length = int(qr[pos+2:pos+4])
+        value = qr[pos+4:pos+4+length]
+        if len(value) != length:
+            raise PayloadError("QR code TLV {} needs {} digits but only {} are left".format(typecrit >> 1, length, len(value)))
+        tlvs.append(TLV(typecrit >> 1, bool(typecrit & 1), value))
+        pos += 4 + length
+    payload = SmartStartPayload(qr, int(qr[2:4]), int(qr[4:9]), keys, dsk, tlvs)
+    payload.product_type, payload.product_id   # check the 16 bit fields
+    return(payload)
+
+def ValidateLog(qrs):
+    ''' Validate a production log of QR code strings.
+        Returns (bad, duplicates): bad is a list of (line index, reason) and duplicates maps each DSK
+        found more than once to the line indexes it was found on.
+        The structure of all the payloads of the same length is checked at once with numpy, the SHA-1
+        checksum (hashlib) and the TLV walk (ParseFields) are done payload by payload - a valid checksum
+        only means the DUT computed it over a corrupted payload too.
+    '''
+    qrs = [qr.strip() for qr in qrs]
+    bad = {}
+    bylength = defaultdict(list)
+    for idx, qr in enumerate(qrs):
+        bylength[len(qr)].append(idx)
+    for length, idxs in bylength.items():
+        if length < MIN_LENGTH:
+            for idx in idxs:
+                bad[idx] = "only {} digits".format(length)
+            continue
+        digits = np.frombuffer("".join(qrs[idx] for idx in idxs).encode("ascii", errors="replace"), dtype=np.uint8)
+        digits = digits.reshape(len(idxs), length) - ord('0')   # anything but 0-9 wraps around to >9
+        notdigit = (digits > 9).any(axis=1)
+        leadin = digits[:, 0:4] @ np.array([1000, 100, 10, 1]) != int(LEAD_IN)*100 + VERSION_SMARTSTART
+        words = digits[:, 12:52].reshape(len(idxs), 8, 5).astype(np.int32) @ np.array([10000, 1000, 100, 10, 1])
+        bigword = (words > 0xFFFF).any(axis=1)
+        for row in np.flatnonzero(notdigit | leadin | bigword):
+            idx = idxs[row]
+            try:
+                Parse(qrs[idx])
+            except PayloadError as err:
+                bad[idx] = str(err)
+        field = digits[:, 4:9].astype(np.int32) @ np.array([10000, 1000, 100, 10, 1])
+        sha = np.frombuffer(b"".join(hashlib.sha1(qrs[idx][9:].encode("ascii", errors="replace")).digest()[:2] for idx in idxs), dtype=">u2")
+        for row in np.flatnonzero((field != sha) & ~(notdigit | leadin | bigword)):
+            bad[idxs[row]] = "checksum {:05d} does not match {:05d}".format(field[row], sha[row])
+        for row in np.flatnonzero((field == sha) & ~(notdigit | leadin | bigword)):
+            try:
+                ParseFields(qrs[idxs[row]])
+            except PayloadError as err:
+                bad[idxs[row]] = str(err)
+    seen = defaultdict(list)
+    for idx, qr in enumerate(qrs):
+        if idx not in bad:
+            seen[qr[12:52]].append(idx)
+    duplicates = {dsk: idxs for dsk, idxs in seen.items() if len(idxs) > 1}
+    return(sorted(bad.items()), duplicates)
+
+def WithChecksum(qr):
+    ''' qr with the checksum field recomputed '''
+    return(qr[0:4] + "{:05d}".format(Checksum(qr[9:])) + qr[9:])
+
+def SelfTest():
+    ''' ValidateLog must reject every payload Parse rejects, including corrupted TLVs behind a valid checksum '''
+    good = "9001111361314438312478026180785254448443755248313627001008193030790220000120051600002025800803001"
+    cases = [
+        good,
+        WithChecksum(good[:-2]),                    # Supported Protocols TLV truncated
+        WithChecksum(good[:-6]),                    # TLV header truncated
+        WithChecksum(good[:78] + "99999" + good[83:]),  # ProductID word above 0xFFFF
+        good[:4] + "00000" + good[9:],              # wrong checksum
+        good[:12] + "99999" + good[17:],            # DSK word above 0xFFFF
+        ]
+    expected = []
+    for idx, qr in enumerate(cases):
+        try:
+            Parse(qr)
+        except PayloadError as err:
+            expected.append(idx)
+    bad, duplicates = ValidateLog(cases)
+    if [idx for idx, reason in bad] != expected or expected != [1, 2, 3, 4, 5]:
+        print("SelfTest FAILED - Parse rejects {} but ValidateLog {}".format(expected, bad))
+        return(False)
+    print("SelfTest passed")
+    return(True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Z-Wave SmartStart QR code payload parser and validator")
+    parser.add_argument("qr", nargs="?", help="QR code string to parse")
+    parser.add_argument("-b", "--bulk", metavar="FILE", help="validate every QR code in FILE (one per line), - for stdin")
+    parser.add_argument("-t", "--test", action="store_true", help="check ValidateLog against Parse with known bad payloads")
+    args = parser.parse_args()
+
+    if args.test:
+        sys.exit(0 if SelfTest() else 1)
+
+    if args.bulk is None:
+        if args.qr is None:
+            parser.print_help()
+            sys.exit(1)
+        try:
+            print(Parse(args.qr))
+        except PayloadError as err:
+            print(err)
+            sys.exit(1)
+        sys.exit(0)
+
+    f = sys.stdin if args.bulk == "-" else open(args.bulk)
+    qrs = [line for line in f if line.strip() and not line.startswith('#')]
+    bad, duplicates = ValidateLog(qrs)
+    for idx, reason in bad:
+        print("QR code {}: {}".format(idx+1, reason))
+    for dsk, idxs in duplicates.items():
+        print("Duplicate DSK {} in QR codes {}".format(dsk, ", ".join(str(idx+1) for idx in idxs)))
+    print("{} QR codes, {} invalid, {} duplicate DSKs".format(len(qrs), len(bad), len(duplicates)))
+    sys.exit(1 if bad or duplicates else 0)
@@ -1,10 +1,12 @@
 ''' Z-Wave SmartStart QRCode generator
 
 Usage: python3 SmartStartQR.py [ASCII characters for the QR code]
+       python3 SmartStartQR.py -b FILE [--resume] - print the labels for every QR code in FILE (- for stdin), see -h
 output: qrProd.png - Image file to be applied to the product. QRCode+PIN.
         qrPack.png - Image file to be applied to the PACKAGE (box) the product comes in. QRCode+DSK
 Typically the image files are then sent to a label printer which are immediate applied to the 
 product to ensure the label matches the DUT.
+SS_ZPL builds the same two labels directly as ZPL for a Zebra printer without any image files.
 
 Z-Wave SmartStart QRCode details:
 Refer to Silabs document SDS13937-4 "Node Provisioning QR Code Format for more details.
@@ -44,6 +46,11 @@ Optional data may be added after this for the UUID16 and other fields but these
 
 # Required Libraries
 import sys
+import os
+import time
+import argparse
+import functools
+import multiprocessing
 import qrcode   # QR Code generating code
 import PIL      # image processing operations
 from PIL import ImageFont
@@ -53,6 +60,85 @@ from PIL import ImageOps
 
 DEBUG = 1  # higher numbers print more debugging messages
 
+# Bold font for the label text - None uses the first of FONT_CANDIDATES found on this computer
+FONT_PATH = None
+FONT_CANDIDATES = [
+    'C:/windows/fonts/Verdanab.ttf',
+    '/usr/share/fonts/truetype/msttcorefonts/Verdana_Bold.ttf',    # Raspberry Pi/Debian: apt install ttf-mscorefonts-installer
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf',
+    '/Library/Fonts/Verdana Bold.ttf',
+    ]
+
+# Batch printing - see BatchPrint
+BATCH_LABELS_PER_JOB = 50   # DUTs (2 labels each) sent to the printer in one job
+BATCH_RETRIES = 5           # retries of a print job before giving up
+BATCH_RETRY_DELAY = 10      # seconds between retries - time to reload labels or clear a jam
+
+# Direct ZPL labels (SS_ZPL) - positions are in 300dpi printer dots
+QR_MAGNIFICATION = 3        # dots per QR module
+LOGO_GRF = "E:ZWLOGO.GRF"   # name of the logo stored by SS_LogoZPL - E: is flash so it survives a printer power cycle
+LOGO_SCALE = 0.85           # logo pixels to printer dots
+PROD_LABEL_HOME = 168       # left edge of the product label in dots
+PACK_LABEL_HOME = 204       # left edge of the package label in dots
+
+class SmartStartLabel():
+    ''' Product and package label template.
+        The fonts, the logo and the static parts of both labels are rendered once when the template is created,
+        render() then only pastes the QR code of the DUT and draws the PIN/DSK text on copies of them.
+    '''
+    QR_BOX = 4      # pixels per QR module
+    QR_SIZE = 124   # label layout size - a 90 digit code is version 3 = 29 modules + 1 module border on each side
+
+    def __init__(self, font_path=None, logo="Z-Wave_Plus_Logo.png"):
+        self.font_path = font_path or FindFont()
+        self.font1=ImageFont.truetype(self.font_path,18)
+        self.font2=ImageFont.truetype(self.font_path,22)
+        x=y=self.QR_SIZE
+        self.prod=Image.new('L', (x+ 180,y+50),255)     # product greyscale image big enough for the QR and text and Z-Wave Plus Logo
+        if logo:    # This is optional - other logos, images or text can be included on the label.
+            self.prod.paste(Image.open(logo),(145,27))
+        ImageDraw.Draw(self.prod).text((14,10),"Z-WAVE DSK",font=self.font1, fill=0)
+        self.pack=Image.new('L', (x+100,y+50),255)      # package image which has the full DSK in text per Z-Wave Certification
+        ImageDraw.Draw(self.pack).text((8,10),"Z-WAVE DSK",font=self.font1, fill=0)
+
+    def qrimage(self, QRin):
+        ''' the QRCode of QRin as a greyscale image - 124x124 for a 90 digit code.
+            fit=True picks a bigger version if the optional TLVs make QRin too long for version 3.
+        '''
+        qr=qrcode.QRCode(version=3, box_size=1, border=1, error_correction=qrcode.constants.ERROR_CORRECT_L)
+        qr.add_data(QRin)
+        qr.make(fit=True)       # build the QRCode
+        if DEBUG>5 and qr.version!=3: print("QR code version {}".format(qr.version))
+        matrix=qr.get_matrix()  # True=black module including the border
+        n=qr.modules_count+2*qr.border
+        img=Image.frombytes('L', (n,n), bytes(0 if m else 255 for row in matrix for m in row))
+        return(img.resize((n*self.QR_BOX,n*self.QR_BOX), Image.NEAREST))
+
+    def render(self, QRin):
+        ''' Returns the (product, package) label images for the QR code string of one DUT '''
+        img2=self.qrimage(QRin)
+        x=img2.size[0]
+        imgProd=self.prod.copy()
+        imgProd.paste(img2,(15,27))     # the X,Y positions may need to be adjusted based on the printer and labels
+        img3=ImageDraw.Draw(imgProd)
+        img3.text((12,143),"PIN:"+QRin[12:17],font=self.font2, fill=0)
+        imgPack=self.pack.copy()
+        imgPack.paste(img2,(10,28))
+        img3=ImageDraw.Draw(imgPack)
+        for i in range(0,8):
+            img3.text((x+22,i*17+15),QRin[i*5+12:i*5+17],font=self.font1, fill=0)
+        img3.text((7,146),"PIN:"+QRin[12:17],font=self.font2, fill=0)
+        return(imgProd, imgPack)
+
+def FindFont():
+    ''' FONT_PATH if it is set otherwise the first of FONT_CANDIDATES that exists on this computer '''
+    for f in ([FONT_PATH] if FONT_PATH else FONT_CANDIDATES):
+        if os.path.exists(f):
+            return(f)
+    raise OSError("No label font found - set FONT_PATH in SmartStartQR.py")
+
+_template = None
+
 class SmartStartQR():
     ''' SmartStart QR Code generator class'''
 
@@ -69,41 +155,174 @@ class SmartStartQR():
             TLV-00 = type=00, len=10, DeviceType=08193, InstallerIconType=03079
             TLV-02 = type=02, len=20, MfgID=00012, ProdType=00516, ProdID=00002, AppVer=02580
         '''    
-        # Generate a SmartStart QRCode Image
-        qr=qrcode.QRCode(version=3, box_size=4, border=1, error_correction=qrcode.constants.ERROR_CORRECT_L)
-        qr.add_data(QRin)
-        qr.make()               # build the QRCode
-        img=qr.make_image()     # convert to an image
-        if DEBUG>5: print("image size={}".format(img.size))
-        (x,y)=img.size          # Typically 124x124
-        img2 = img.get_image()  # to pass the checks inside Image.paste, convert the QRcode.PIL image into an Image.Image
-        imgProd=Image.new('L', (x+ 180,y+50),255)       # create product greyscale image big enough for the QR and text and Z-Wave Plus Logo
-        imgProd.paste(img2,(15,27))     # the X,Y positions may need to be adjusted based on the printer and labels
-        imgZWLogo=Image.open("Z-Wave_Plus_Logo.png") # This is optional 
-        # other logos, images or text can be included on the label.
-        # The final size of the label is managed by the printer drivers for the printer.
-        imgProd.paste(imgZWLogo,(145,27))
-        img3=ImageDraw.Draw(imgProd)
-        font1=ImageFont.truetype('C:/windows/fonts/Verdanab.ttf',18)
-        font2=ImageFont.truetype('C:/windows/fonts/Verdanab.ttf',22)
-        img3.text((14,10),"Z-WAVE DSK",font=font1, fill=0)
-        img3.text((12,143),"PIN:"+QRin[12:17],font=font2, fill=0)
+        imgProd, imgPack = SmartStartQR.Template().render(QRin)
         imgProd.save("qrProd.png")                  # This image goes ON the PRODUCT itself
-
-        imgPack=Image.new('L', (x+100,y+50),255)     # create the package image which has the full DSK in text per Z-Wave Certification
-        imgPack.paste(img2,(10,28))
-        img3=ImageDraw.Draw(imgPack)
-        img3.text((8,10),"Z-WAVE DSK",font=font1, fill=0)
-        for i in range(0,8):
-            img3.text((x+22,i*17+15),QRin[i*5+12:i*5+17],font=font1, fill=0)
-        img3.text((7,146),"PIN:"+QRin[12:17],font=font2, fill=0)
         imgPack.save("qrPack.png")                  # This is the image that goes on the outside of the box
 
+    def Template(font_path=None):
+        ''' Returns the SmartStartLabel template - created on the first call and then reused for every label '''
+        global _template
+        if _template is None or (font_path and font_path != _template.font_path):
+            _template = SmartStartLabel(font_path)
+        return(_template)
+
+    def SS_LogoZPL(filename="Z-Wave_Plus_Logo.png"):
+        ''' Returns the ZPL ~DG command that stores the logo in the printer memory as LOGO_GRF.
+            Send it to the printer once (IE: when the printer is initialized) - SS_ZPL then only recalls it by name.
+        '''
+        img=Image.open(filename).convert('L')
+        img=img.resize((int(img.size[0]*LOGO_SCALE), int(img.size[1]*LOGO_SCALE)))
+        img=img.point(lambda p: 255 if p <= 127 else 0).convert('1')    # ZPL graphics are 1=black so dark pixels become 1 bits
+        rowbytes=(img.size[0]+7)//8
+        data=img.tobytes()      # packed 1 bit per pixel, each row padded to a byte
+        return "~DG{},{},{},{}".format(LOGO_GRF, len(data), rowbytes, data.hex().upper())
+
+    def SS_ZPL(QRin="9001111361314438312478026180785254448443755248313627001008193030790220000120051600002025800803001"):
+        ''' Returns the ZPL for the product and package labels as a tuple of 2 strings - no image files are created.
+            The QR code is drawn by the printer (^BQ), the text uses the printer font and the logo is
+            recalled from printer memory so SS_LogoZPL must have been sent to the printer first.
+            The positions are in printer dots (300dpi) and may need to be adjusted based on the printer and labels.
+        '''
+        pin=QRin[12:17]
+        prod=("^XA^LH{},0".format(PROD_LABEL_HOME) +
+            "^FO12,8^A0N,18,18^FDZ-WAVE DSK^FS" +
+            "^FO13,14^BQN,2,{}^FDLA,{}^FS".format(QR_MAGNIFICATION, QRin) +     # ^BQ adds ~10 dots above the code
+            "^FO124,23^XG{},1,1^FS".format(LOGO_GRF) +
+            "^FO10,122^A0N,22,22^FDPIN:{}^FS".format(pin) +
+            "^XZ")
+        pack=("^XA^LH{},0".format(PACK_LABEL_HOME) +
+            "^FO7,8^A0N,18,18^FDZ-WAVE DSK^FS" +
+            "^FO8,14^BQN,2,{}^FDLA,{}^FS".format(QR_MAGNIFICATION, QRin) +
+            "".join("^FO123,{}^A0N,15,15^FD{}^FS".format(i*14+13, QRin[i*5+12:i*5+17]) for i in range(0,8)) +
+            "^FO6,123^A0N,19,19^FDPIN:{}^FS".format(pin) +
+            "^XZ")
+        return(prod, pack)
+
+def RenderLabels(QRin, png=False):
+    ''' ZPL for the package and product labels of one QR code string.
+        png=True renders the label images with the template and converts them to ZPL graphics like
+        ZRADCalProgTest.zeb_print does - otherwise the labels are built directly with SS_ZPL.
+    '''
+    if not png:
+        prod, pack = SmartStartQR.SS_ZPL(QRin)
+        return(pack + prod)
+    import zpl      # Zebra ZPL creation library - only needed for the PNG labels
+    imgProd, imgPack = SmartStartQR.Template().render(QRin)
+    out = ""
+    for img, home, width in ((imgPack, 17, 16), (imgProd, 14, 22)):    # home and width in mm
+        l = zpl.Label(25.4*4,12.7*4,12) # 1x0.5" at 300dpi
+        l.origin(home,0)
+        l.write_graphic(img,width)
+        l.endorigin()
+        out += l.dumpZPL()
+    return(out)
+
+def ReadQRStrings(f):
+    ''' QR code strings from a file - one per line, blank lines and # comments are skipped '''
+    for line in f:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line
+
+def OpenPrinter(queue=None):
+    ''' The Zebra printer on the first queue with ZPL in the name or the queue given '''
+    import zebra    # Zebra label printer library
+    zeb = zebra.Zebra()
+    if queue is None:
+        for zz in zeb.getqueues():
+            if "ZPL" in zz: queue = zz
+    if queue is None:
+        raise OSError("Zebra Printer not found")
+    zeb.setqueue(queue)
+    return(zeb)
+
+def BatchPrint(qrs, output, png=False, jobs=None, per_job=BATCH_LABELS_PER_JOB, skip=0, checkpoint=None):
+    ''' Render every QR string in qrs across a pool of processes and send them to output (a function taking
+        one ZPL string) in print jobs of per_job DUTs. The first skip strings are not printed (already done).
+        After every job the number of QR strings printed is written to the checkpoint file so the batch can
+        be resumed after a printer fault. Returns the number of QR strings printed.
+    '''
+    qrs = list(qrs)[skip:]
+    done = skip
+    start = time.time()
+    with multiprocessing.Pool(jobs) as pool:
+        labels = pool.imap(functools.partial(RenderLabels, png=png), qrs, chunksize=32)
+        job = []
+        for zplcode in labels:
+            job.append(zplcode)
+            if len(job) == per_job:
+                done = SendJob(output, job, done, checkpoint)
+                job = []
+                if DEBUG>0: print("{} labels {:.1f} labels/s".format(2*(done-skip), 2*(done-skip)/(time.time()-start)), flush=True)
+        if job:
+            done = SendJob(output, job, done, checkpoint)
+    elapsed = time.time()-start
+    if DEBUG>0: print("Printed {} labels for {} DUTs in {:.1f}s = {:.1f} labels/s".format(2*(done-skip), done-skip, elapsed, 2*(done-skip)/max(elapsed,1e-6)))
+    return(done)
+
+def SendJob(output, job, done, checkpoint):
+    ''' Send one multi-label job - retries BATCH_RETRIES times before giving up with the checkpoint saved '''
+    for retry in range(BATCH_RETRIES+1):
+        try:
+            output("".join(job))
+            break
+        except Exception as err:
+            print("Printer error: {} - retry {} of {}".format(err, retry+1, BATCH_RETRIES), flush=True)
+            if retry == BATCH_RETRIES:
+                raise
+            time.sleep(BATCH_RETRY_DELAY)
+    done += len(job)
+    if checkpoint:
+        with open(checkpoint, "w") as f:
+            f.write("{}\n".format(done))
+    return(done)
+
 if __name__ == "__main__": # run the script standalone but typically the methods are called from a programming script
-    #q=SmartStartQR()
-    if len(sys.argv) < 2:
-        print("Building a sample QR Code")
-        SmartStartQR.SS_QRGen()
+    parser = argparse.ArgumentParser(description="Z-Wave SmartStart QR code label generator")
+    parser.add_argument("qr", nargs="?", help="QR code string - a sample is used if not given")
+    parser.add_argument("-b", "--batch", metavar="FILE", help="print the labels for every QR code string in FILE, - for stdin")
+    parser.add_argument("--resume", action="store_true", help="skip the QR codes already printed according to FILE.done")
+    parser.add_argument("--png", action="store_true", help="batch: print the PNG style labels as graphics instead of direct ZPL")
+    parser.add_argument("-j", "--jobs", type=int, help="batch: number of rendering processes (default is the number of CPUs)")
+    parser.add_argument("-n", "--per-job", type=int, default=BATCH_LABELS_PER_JOB, help="batch: DUTs per print job")
+    parser.add_argument("-p", "--printer", help="batch: printer queue (default is the first queue with ZPL in its name)")
+    parser.add_argument("-o", "--output", help="batch: write the ZPL to this file instead of the printer")
+    args = parser.parse_args()
+
+    if args.batch is None:
+        if args.qr is None:
+            print("Building a sample QR Code")
+            SmartStartQR.SS_QRGen()
+        else:
+            SmartStartQR.SS_QRGen(args.qr)
+        print("QR codes generated - see qrPack.png * qrProd.png")
+        sys.exit(0)
+
+    if args.batch == "-":
+        qrs = list(ReadQRStrings(sys.stdin))
+        checkpoint = None
+    else:
+        with open(args.batch) as f:
+            qrs = list(ReadQRStrings(f))
+        checkpoint = args.batch + ".done"
+    skip = 0
+    if args.resume and checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            skip = int(f.read().strip() or 0)
+        print("Resuming after {} of {} QR codes".format(skip, len(qrs)))
+    if args.output:
+        zplfile = open(args.output, "a" if args.resume else "w")
+        output = zplfile.write
     else:
-        SmartStartQR.SS_QRGen(sys.argv[1])
-    print("QR codes generated - see qrPack.png * qrProd.png")
+        zplfile = None
+        output = OpenPrinter(args.printer).output
+    if not args.png:
+        output(SmartStartQR.SS_LogoZPL())   # the direct ZPL labels recall the logo from printer memory
+    try:
+        BatchPrint(qrs, output, args.png, args.jobs, args.per_job, skip, checkpoint)
+    except Exception as err:
+        print("Batch stopped: {} - fix the printer and run again with --resume".format(err))
+        sys.exit(1)
+    finally:
+        if zplfile:
+            zplfile.close()
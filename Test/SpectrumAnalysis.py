@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+''' Sub-bin carrier frequency estimation from a TinySA trace
+
+    The TinySA marker only gives the frequency of the highest bin so the accuracy is half a bin which is why
+    the crystal calibration needed 145 points over 60kHz at RBW 1kHz. Fitting the shape of the carrier
+    through the bins around the peak finds the center to a small fraction of a bin instead, so the sweep
+    can use far fewer points and a wider (faster) RBW.
+
+    The RBW filter of the TinySA is close to Gaussian so the carrier is a parabola in dB:
+    "GAUSSIAN"  - least squares parabola through the levels in dB of the bins within FIT_DB of the peak
+    "PARABOLIC" - the same parabola fit on the linear power (mW) - less sensitive to noise in the skirts
+    Every estimate has a confidence from 0 to 1 from the SNR and the standard error of the fitted center, which
+    shrinks as more bins are fitted. A peak on the edge of the sweep, a center outside of the fitted bins or
+    something that isn't a peak at all gets 0.
+
+    Accuracy with 0.5-1dB of level jitter on every point (Monte Carlo of the fit on simulated 3kHz RBW traces,
+    carrier anywhere in the window, 95th percentile of the error at 1dB): 21 points over 10kHz 110Hz, 61 points
+    over 60kHz 160Hz. The old marker with 145 points over 60kHz at RBW 1kHz is 200Hz without jitter and 350Hz with 1dB.
+    EstimatePeaks finds several carriers in one trace (IE: two DUTs calibrated with one sweep).
+    MeasureSpectrum finds the noise floor and the highest spur away from the carriers of a trace.
+
+    Usage: python SpectrumAnalysis.py [START STOP POINTS] - sweeps the TinySA once and prints the estimate and the marker
+'''
+import sys
+from collections import namedtuple
+import numpy as np
+
+DEBUG = 3   # print debug messages - the higher the value, the more details are printed
+
+PEAK_METHOD = "GAUSSIAN"
+FIT_DB = 15.0       # bins within this many dB of the peak are fitted - more bins average out the level jitter
+MIN_SNR = 10.0      # dB above the noise floor for any confidence
+GOOD_SNR = 30.0     # dB above the noise floor for full confidence
+FIT_STDERR = 0.25   # standard error of the fitted center in bins that halves the confidence
+NOISE_PERCENTILE = 10   # percentile of the trace taken as the noise floor
+
+# frequency and level of the fitted carrier, confidence 0-1, SNR in dB and the index of the highest bin
+PeakEstimate = namedtuple("PeakEstimate", ["frequency", "level", "confidence", "snr", "index"])
+
+# noise floor and highest level in dBm of the points away from the carriers, the frequency of the highest level and the number of points
+Spectrum = namedtuple("Spectrum", ["noise", "spur", "spur_freq", "points"])
+
+def EstimatePeak(freqs, levels, method=PEAK_METHOD, noise=None):
+    ''' Returns the PeakEstimate of the strongest carrier in the trace. freqs in Hz and levels in dBm are arrays of the same length.
+        noise is the noise floor in dBm if it is already known otherwise it is estimated from the trace.
+    '''
+    freqs = np.asarray(freqs, dtype=np.float64)
+    levels = np.asarray(levels, dtype=np.float64)
+    i = int(np.argmax(levels))
+    if noise is None:   # a narrow sweep is mostly carrier so the median is not the noise floor - the lowest 10% of the bins are
+        noise = np.percentile(levels, NOISE_PERCENTILE)
+    snr = float(levels[i] - noise)
+    if i == 0 or i == len(levels)-1:    # the real peak may be outside of the sweep
+        return(PeakEstimate(float(freqs[i]), float(levels[i]), 0.0, snr, i))
+    below = levels < levels[i] - FIT_DB     # the main lobe is the bins around the peak down to FIT_DB
+    left = np.flatnonzero(below[:i])
+    right = np.flatnonzero(below[i+1:])
+    lo = min(i-1, left[-1]+1 if len(left) else 0)
+    hi = max(i+2, i+1+right[0] if len(right) else len(levels))
+    step = (freqs[-1]-freqs[0])/(len(freqs)-1)
+    x = (freqs[lo:hi]-freqs[i])/step    # in bins from the highest bin
+    y = levels[lo:hi] if method == "GAUSSIAN" else 10**(levels[lo:hi]/10)
+    A = np.vander(x, 3)
+    (a, b, c), residual, rank, sv = np.linalg.lstsq(A, y, rcond=None)
+    if a >= 0:      # not a peak
+        return(PeakEstimate(float(freqs[i]), float(levels[i]), 0.0, snr, i))
+    delta = -b/(2*a)
+    top = c - b*b/(4*a)
+    level = top if method == "GAUSSIAN" else 10*np.log10(max(top, 1e-30))
+    stderr = np.inf     # 3 bins fit exactly so there is nothing to tell the jitter from the carrier
+    if len(x) > 3:      # propagate the covariance of the fit to the center -b/2a
+        cov = np.sum((y - A @ (a, b, c))**2)/(len(x)-3) * np.linalg.inv(A.T @ A)
+        grad = np.array([b/(2*a*a), -1/(2*a), 0])
+        stderr = float(np.sqrt(max(grad @ cov @ grad, 0)))    # in bins whatever the units of y
+    confidence = np.clip((snr-MIN_SNR)/(GOOD_SNR-MIN_SNR), 0, 1) / (1 + (stderr/FIT_STDERR)**2)
+    if not x[0] < delta < x[-1]:    # the center must be inside the fitted bins
+        confidence = 0.0
+    delta = max(x[0], min(x[-1], delta))
+    return(PeakEstimate(float(freqs[i] + delta*step), float(level), float(confidence), snr, i))
+
+def EstimatePeaks(freqs, levels, count, separation, method=PEAK_METHOD):
+    ''' Returns the PeakEstimates of up to count carriers at least separation Hz apart - strongest first.
+        Each carrier is fitted on the bins within separation/2 of its highest bin against the noise floor of the whole trace.
+    '''
+    freqs = np.asarray(freqs, dtype=np.float64)
+    levels = np.asarray(levels, dtype=np.float64)
+    noise = np.percentile(levels, NOISE_PERCENTILE)
+    step = (freqs[-1]-freqs[0])/(len(freqs)-1)
+    half = max(2, int(separation/2/step))
+    free = np.ones(len(levels), dtype=bool)     # bins not within separation of a carrier already found
+    peaks = []
+    while len(peaks) < count and free.any():
+        i = int(np.flatnonzero(free)[np.argmax(levels[free])])
+        free[max(0, i-2*half):i+2*half+1] = False
+        lo = max(0, i-half)
+        peak = EstimatePeak(freqs[lo:i+half+1], levels[lo:i+half+1], method, noise)
+        if peak.index+lo != i:  # the skirt of a stronger carrier
+            continue
+        peaks.append(peak._replace(index=i))
+    return(peaks)
+
+def MeasureSpectrum(freqs, levels, carriers, exclusion):
+    ''' Returns the Spectrum of the points more than exclusion Hz from every carrier frequency listed.
+        The noise floor is the median of those points and the spur is the highest one - both None if there are no such points.
+    '''
+    freqs = np.asarray(freqs, dtype=np.float64)
+    levels = np.asarray(levels, dtype=np.float64)
+    away = np.ones(len(freqs), dtype=bool)
+    for fc in carriers:
+        away &= np.abs(freqs-fc) > exclusion
+    if not away.any():
+        return(Spectrum(None, None, None, 0))
+    i = np.flatnonzero(away)[np.argmax(levels[away])]
+    return(Spectrum(float(np.median(levels[away])), float(levels[i]), float(freqs[i]), int(away.sum())))
+
+if __name__ == "__main__":
+    sys.path.insert(0, './tinySA')
+    import tinySA as sa
+    start, stop, points = (float(sys.argv[1]), float(sys.argv[2]), int(sys.argv[3])) if len(sys.argv) > 3 else (908390000, 908450000, 61)
+    tsa = sa.tinySA()
+    tsa.send_scan(start, stop, points)
+    tsa.set_frequencies(start, stop, points)
+    levels = tsa.data()
+    peak = EstimatePeak(tsa.frequencies, levels)
+    print(peak)
+    print(MeasureSpectrum(tsa.frequencies, levels, [peak.frequency], 10000))
+    print("marker={}".format(tsa.fetch_marker()))
+    tsa.close()
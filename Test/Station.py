@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+''' Test station configuration and shared resource scheduler for ZRADCalProgTest
+
+    A station is any number of jigs, each with its own WSTK, plus the instruments shared by all of them.
+    The jigs are listed in a JSON file which is passed to ZRADCalProgTest with STATION=<file>:
+
+    {
+        "jigs": [
+            {"name": "LEFT",  "com": "COM4", "ser": "440263534", "arrow": "<"},
+            {"name": "RIGHT", "com": "COM5", "ser": "440263535", "arrow": ">"},
+            {"name": "JIG3",  "ser": "440263536"}
+        ],
+        "analyzers": [
+            {"serial": "400"},
+            {"serial": "401", "jigs": ["JIG3"]}
+        ],
+        "resources": {"printer": 1}
+    }
+
+    com is the WSTK serial port for RailTest and ser is the WSTK serial number used by Commander.
+    com is found from the serial number if it is not given.
+    analyzers lists the TinySAs by USB serial number (or "port") and the jigs each one can measure (all if not given).
+    Every TinySA connected is used if there is no list - see ZG23CrystalCal.AnalyzerPool. Crystal calibration waits
+    for a free TinySA so with only one it is serialized across all the jigs (except for two jigs calibrated together -
+    see ZG23CrystalCal.CalPairing) while every other step runs concurrently.
+    resources lists how many of each other shared instrument the station has.
+
+    Usage: python Station.py [station.json] - prints the station configuration
+'''
+import sys
+import json
+import threading
+import time
+import Metrics
+from contextlib import contextmanager
+
+DEBUG = 3   # print debug messages - the higher the value, the more details are printed
+
+# Shared instruments and how many of each a station has unless the config says otherwise
+DEFAULT_RESOURCES = {"printer": 1}
+
+def DefaultStation(lcom="COM4", rcom=None, lser="440263534", rser="456"):
+    ''' The classic two jig station configured with LCOM/RCOM/LSER/RSER - the right jig is only used if RCOM is given '''
+    jigs = [{"name": "LEFT", "com": lcom, "ser": lser, "arrow": "<"}]
+    if rcom is not None:
+        jigs.append({"name": "RIGHT", "com": rcom, "ser": rser, "arrow": ">"})
+    return {"jigs": jigs, "resources": dict(DEFAULT_RESOURCES)}
+
+def LoadStation(filename):
+    ''' Read the station configuration JSON file and fill in any defaults '''
+    with open(filename) as f:
+        station = json.load(f)
+    if len(station.get("jigs", [])) == 0:
+        raise ValueError("{} does not list any jigs".format(filename))
+    for idx, jig in enumerate(station["jigs"]):
+        if "ser" not in jig:
+            raise ValueError("jig {} in {} needs the WSTK serial number ser".format(idx, filename))
+        jig.setdefault("name", "JIG{}".format(idx+1))
+        jig.setdefault("arrow", ">")
+    names = [jig["name"] for jig in station["jigs"]]
+    for idx, analyzer in enumerate(station.get("analyzers", [])):
+        if "serial" not in analyzer and "port" not in analyzer:
+            raise ValueError("analyzer {} in {} needs a serial or port".format(idx, filename))
+        for name in analyzer.get("jigs", []):
+            if name not in names:
+                raise ValueError("analyzer {} in {} lists jig {} which is not in jigs".format(idx, filename, name))
+    resources = dict(DEFAULT_RESOURCES)
+    resources.update(station.get("resources", {}))
+    station["resources"] = resources
+    return station
+
+class ResourceScheduler:
+    ''' Hands out the shared station instruments to the jigs.
+        Each pipeline step asks for the resources it needs and blocks until they are free.
+        Resources are always acquired in the same (sorted) order so two jigs can never deadlock.
+    '''
+
+    def __init__(self, resources=DEFAULT_RESOURCES):
+        self.sem = {}
+        for name, count in resources.items():
+            self.sem[name] = threading.BoundedSemaphore(count)
+
+    @contextmanager
+    def use(self, *names):
+        ''' with sched.use("printer"): ... - holds the named resources for the duration of the block '''
+        names = sorted(set(names))
+        held = []
+        try:
+            for name in names:
+                start = time.time()
+                self.sem[name].acquire()
+                held.append(name)
+                Metrics.Record("wait", name, start, time.time()-start)
+                if DEBUG>6: print("{} acquired after {:.2f}s".format(name, time.time()-start))
+            yield
+        finally:
+            for name in reversed(held):
+                self.sem[name].release()
+
+if __name__ == "__main__":
+    station = LoadStation(sys.argv[1]) if len(sys.argv) > 1 else DefaultStation()
+    for idx, jig in enumerate(station["jigs"]):
+        print("{}: {} {} WSTK COM={} SN={}".format(idx+1, jig["arrow"], jig["name"], jig.get("com", "auto"), jig["ser"]))
+    for idx, analyzer in enumerate(station.get("analyzers", [])):
+        print("TinySA {}: {} jigs={}".format(idx+1, analyzer.get("serial") or analyzer.get("port"), ", ".join(analyzer.get("jigs", ["all"]))))
+    print("Resources: {}".format(station["resources"]))
@@ -3,8 +3,10 @@
     Adjusts the CTUNE value until the RF carrier frequency is within 1000Hz (1ppm).
     Programs the CTUNE value into NVM when complete.
     Returns the CTUNE value if calibration worked - otherwise 0,
+    The CTUNE search learns the Hz per CTUNE step from previous boards - see CtuneSolver.
     Requires a TinySA spectrum analyzer and a Silabs WSTK ProDevKit
     The DUT must have RailTest programmed into it (tested with 2.15.0)
+    or an application built with the RAIL test CLI which answers the same commands.
     Note that the CTUNE is RETURNED! But not programmed into the DUT NVM. 
     A higher level script is expected to program Railtest, run this script, then store the value in the DUT NVM.
 
@@ -14,6 +16,12 @@ import serial   # install the pySerial library and not serial ("pip install pyse
 import time
 import sys, os
 import traceback
+import json
+import threading
+from contextlib import contextmanager
+import Metrics
+import RailTest
+import SpectrumAnalysis
 sys.path.insert(0,'./tinySA') # add the TinySA library to the path - this was downloaded from tinysa.org and then improved
 import tinySA as sa # needs numpy and matplotlib libraries
 
@@ -23,8 +31,13 @@ DEBUG = 3   # print debug messages - the higher the value, the more details are
 WSTK_VID = 0x1366
 WSTK_PID =  0x0105
 
+# COM port of the TinySA - None finds it by its USB IDs
+# A station with several TinySAs lists them by serial number instead - see AnalyzerPool below
+TINYSA_PORT = None
+
 # The crystal must be calibrated to within 1ppm or 1000hz
 TARGET_FREQ = 908420000
+CHANNEL_FREQ = {1: 908400000, 2: 908420000}    # RailTest Z-Wave US channels the carrier can be on - the same CTUNE centers both
 MIN_FREQ = TARGET_FREQ-1000
 MAX_FREQ = TARGET_FREQ+1000
 START_FREQ=TARGET_FREQ-30000
@@ -32,37 +45,239 @@ STOP_FREQ =TARGET_FREQ+30000
 # number of frequencies to scan in the range above - the more points, the slower the scan so this is a fairly good balance
 POINTS_SCAN = 145
 
-# Number of adjustments to CTUNE before giving up. Usually takes 3-5 trials.
+# Coarse to fine measurement. The first trial sweeps START_FREQ..STOP_FREQ to find the carrier, after that only a
+# narrow window centered on where the carrier is expected to be is swept which is much faster with fewer points.
+# If the peak is not inside the narrow window the wide sweep is repeated.
+# "WIDE" sweeps the full START_FREQ..STOP_FREQ window on every trial
+SWEEP_MODE = "ADAPTIVE"
+NARROW_SPAN = 10000     # Hz
+NARROW_POINTS = 51      # 200Hz per point - better resolution than the wide sweep in about a third of the time
+
+# How the carrier frequency is found in a sweep.
+# "MARKER" is the frequency of the highest point from the TinySA marker which is only as accurate as the point spacing.
+# "FIT" fits the shape of the carrier through the whole trace (see SpectrumAnalysis.py) which is accurate to a small
+# fraction of a point so the sweeps use fewer points and the faster 3kHz RBW - about 1/7th of the sweep time.
+PEAK_ESTIMATOR = "FIT"
+FIT_RBW = 3             # kHz
+FIT_POINTS_SCAN = 61    # 1kHz per point over START_FREQ..STOP_FREQ - about 160Hz (95%) with 1dB of level jitter
+FIT_NARROW_POINTS = 21  # 500Hz per point over NARROW_SPAN - about 110Hz (95%) with 1dB of level jitter
+MIN_PEAK_CONFIDENCE = 0.5   # a fit with less confidence is not a measurement - see SpectrumAnalysis.EstimatePeak
+
+# Two jigs that reach the TinySA at about the same time calibrate together - see CalPairing and CalibratePair below.
+# The first DUT transmits on channel 2 and the second on channel 1 (20kHz lower) so one sweep measures both carriers.
+# Needs PEAK_ESTIMATOR="FIT" to find both peaks - False calibrates one DUT at a time.
+# A pair saves about one wide sweep and one TinySA setup, so it only pays off when the TinySA is the bottleneck
+# (several jigs sharing one) and the other jig is about to arrive - a jig never waits longer than PAIR_WAIT.
+CAL_PAIRING = False
+PAIR_CHANNELS = (2, 1)
+PAIR_WAIT = 0.5         # seconds - a jig only waits at the TinySA for another jig expected to arrive within this (about one sweep)
+PAIR_SEPARATION = 8000  # Hz - carriers expected closer than this are measured one at a time
+
+# The carrier power, noise floor and spurs are taken from the calibration sweeps (FIT only) - see Harvest below
+SPUR_EXCLUSION = 10000  # Hz either side of a carrier that is not searched for spurs (the carrier skirts)
+
+UART_SETTLE = 0.5       # seconds for the DUT UART to settle after RailTest boots
+
+# Number of adjustments to CTUNE before giving up. Usually takes 1-2 trials with the CtuneSolver.
 MAX_TRIALS = 12
 
+# CTUNE solver - see CtuneSolver below
+CTUNE_SLOPE = -1500     # Hz per CTUNE step until enough boards have been calibrated to learn it
+CTUNE_MIN = 0           # range of the CTUNE register
+CTUNE_MAX = 255
+CTUNE_MAX_STEP = 30     # limit the amount of change in ctune for each trial
+CTUNE_PRIOR_FILE = "ctune_prior.json"   # slope and intercept learned from the boards calibrated so far
+CTUNE_PRIOR_MIN_BOARDS = 3  # start at the average CTUNE of previous boards once there are this many
+CTUNE_PRIOR_WEIGHT = 0.05   # weight of each new board in the running average of the prior
+
+# CTUNE of every chip calibrated so far by its unique ID - see CtuneCache below
+CTUNE_CACHE_FILE = "ctune_cache.json"
+CTUNE_CACHE_MAX_AGE = 90*24*3600    # seconds - older values are recalibrated from scratch
+CTUNE_CACHE_VERIFY = True           # check the cached CTUNE with one sweep - False restores it without RailTest or the TinySA
+
 # Minimum RSSI signal stength to accept a txtone marker from the TinySA in dBm.
 # Typically should be about -8 if the DUT is with 1 foot of the tinySA and has an antenna installed
 # If multiple test stations are nearby, this value may want to be higher (IE: -10) to ignore adjacent stations. 
 # Adjacent test stations typically must be at least 5 meters apart or they will interfere with each other.
 MIN_RSSI_TXTONE = -20
 
-def getwstkport() -> str:
-    device_list = serial.tools.list_ports.comports()
-    for device in device_list:
-        if device.vid == WSTK_VID and device.pid == WSTK_PID:
-            return device.device
-    raise OSError("No WSTK found")
+def getwstkports() -> list:
+    ''' [(USB serial number, port)] of every WSTK connected - the serial number is the one Commander uses without the leading 0s '''
+    return sorted(((device.serial_number or "").lstrip("0"), device.device) for device in serial.tools.list_ports.comports()
+                  if device.vid == WSTK_VID and device.pid == WSTK_PID)
+
+def getwstkport(wstkser=None) -> str:
+    ''' port of the WSTK with the serial number - the first one found if None '''
+    for sn, port in getwstkports():
+        if wstkser is None or sn == str(wstkser).lstrip("0"):
+            return port
+    raise OSError("No WSTK found" if wstkser is None else "WSTK {} not found".format(wstkser))
+
+_prior_lock = threading.Lock()
+
+class CtuneSolver:
+    ''' Picks the next CTUNE to try from the frequencies measured so far.
+        The carrier is modeled as a straight line: freq = target + slope*(ctune-intercept)
+        where slope is Hz per CTUNE step (negative - more capacitance lowers the frequency) and intercept is the
+        CTUNE that puts the carrier on target (TARGET_FREQ unless the DUT is on another channel). The first step uses the slope learned from previous boards,
+        once there are 2 or more measurements the slope is fitted (secant/least squares) from this board.
+        The slope and intercept are averaged over the boards calibrated so far and saved in CTUNE_PRIOR_FILE
+        so the first guess is usually within 1ppm and most boards need only 1-2 sweeps.
+    '''
+
+    def __init__(self, priorfile=CTUNE_PRIOR_FILE, target=TARGET_FREQ):
+        self.priorfile = priorfile
+        self.target = target    # frequency of the channel the carrier is on
+        self.prior = {"slope": CTUNE_SLOPE, "intercept": None, "boards": 0}
+        try:
+            with open(priorfile) as f:
+                self.prior.update(json.load(f))
+        except (OSError, ValueError):
+            pass    # no boards calibrated yet
+        self.points = []    # (ctune, freq) measured on this board
+
+    def first(self, ctune):
+        ''' the CTUNE to start with - the average of previous boards if there is one otherwise the DUT current value '''
+        if self.prior["intercept"] is not None and self.prior["boards"] >= CTUNE_PRIOR_MIN_BOARDS:
+            return(int(round(self.prior["intercept"])))
+        return(ctune)
+
+    def slope(self):
+        ''' Hz per CTUNE step fitted from this board - falls back to the prior if the fit looks unreasonable '''
+        prior = self.prior["slope"]
+        if len(set(c for c, f in self.points)) < 2:
+            return(prior)
+        n = len(self.points)
+        cm = sum(c for c, f in self.points)/n
+        fm = sum(f for c, f in self.points)/n
+        sxx = sum((c-cm)**2 for c, f in self.points)
+        sxy = sum((c-cm)*(f-fm) for c, f in self.points)
+        slope = sxy/sxx
+        if not (0.25*abs(prior) < abs(slope) < 4*abs(prior)) or (slope > 0) != (prior > 0):
+            if DEBUG>2: print("fitted slope {:.0f}Hz/step ignored".format(slope))
+            return(prior)
+        return(slope)
+
+    def next(self, ctune, freq):
+        ''' Record the frequency measured at ctune and return the next CTUNE to try '''
+        self.points.append((ctune, freq))
+        step = (self.target-freq)/self.slope()
+        step = max(-CTUNE_MAX_STEP, min(CTUNE_MAX_STEP, int(round(step))))
+        if step == 0:       # outside of the window so always move at least 1 step
+            step = 1 if (self.target-freq)/self.prior["slope"] > 0 else -1
+        return(max(CTUNE_MIN, min(CTUNE_MAX, ctune+step)))
+
+    def predict(self, ctune):
+        ''' expected carrier frequency at ctune based on the last measurement or None if nothing was measured yet '''
+        if len(self.points) == 0:
+            return(None)
+        c, f = self.points[-1]
+        return(f + self.slope()*(ctune-c))
+
+    def done(self, ctune, freq):
+        ''' Calibration passed - fold this board into the prior and save it for the next board '''
+        self.points.append((ctune, freq))
+        slope = self.slope()
+        intercept = ctune + (self.target-freq)/slope
+        with _prior_lock:
+            try:    # another jig may have updated the prior while this board was calibrating
+                with open(self.priorfile) as f:
+                    self.prior.update(json.load(f))
+            except (OSError, ValueError):
+                pass
+            boards = self.prior["boards"]
+            weight = max(CTUNE_PRIOR_WEIGHT, 1/(boards+1))  # plain average for the first few boards then a running average
+            self.prior["slope"] += weight*(slope-self.prior["slope"])
+            if self.prior["intercept"] is None:
+                self.prior["intercept"] = intercept
+            else:
+                self.prior["intercept"] += weight*(intercept-self.prior["intercept"])
+            self.prior["boards"] = boards+1
+            try:
+                tmp = self.priorfile + ".tmp"
+                with open(tmp, "w") as f:
+                    json.dump(self.prior, f, indent=1)
+                os.replace(tmp, self.priorfile)
+            except OSError as err:
+                print("Unable to save the CTUNE prior: {}".format(err))
+
+class CtuneCache:
+    ''' The calibrated CTUNE of every chip by its EFR32 unique ID so a re-tested board (IE: after FactoryFresh erased
+        the CTUNE token) starts from its own value. The calibration then normally passes on the first sweep
+        which doubles as the verification - if it doesn't the board is simply recalibrated from there.
+        The file has one JSON line per calibration and is only appended to - the last line for a chip wins.
+    '''
+
+    def __init__(self, cachefile=CTUNE_CACHE_FILE):
+        self.cachefile = cachefile
+        self.lock = threading.Lock()
+        self.cache = {}
+        try:
+            with open(cachefile) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue    # half written line from a power failure
+                    self.cache[entry["uid"]] = entry
+        except OSError:
+            pass    # no chips calibrated yet
+
+    def get(self, uid):
+        ''' the cached CTUNE of the chip or None if it was never calibrated or the value is stale '''
+        with self.lock:
+            entry = self.cache.get(uid)
+        if entry is None or time.time()-entry["time"] > CTUNE_CACHE_MAX_AGE:
+            return(None)
+        return(entry["ctune"])
+
+    def put(self, uid, ctune):
+        entry = {"uid": uid, "ctune": ctune, "time": time.time()}
+        with self.lock:
+            self.cache[uid] = entry
+            try:
+                with open(self.cachefile, "a") as f:
+                    f.write(json.dumps(entry) + "\n")
+            except OSError as err:
+                print("Unable to save the CTUNE cache: {}".format(err))
+
+_ctune_cache = None
+
+def GetCtuneCache():
+    ''' the CtuneCache shared by all the jigs '''
+    global _ctune_cache
+    with _prior_lock:
+        if _ctune_cache is None:
+            _ctune_cache = CtuneCache()
+        return(_ctune_cache)
 
 class ZG23CrystalCal:
-    def __init__(self):
+    def __init__(self, wstk=None, wstkser="123"):
+        ''' wstk is the COM port of the WSTK running RailTest - the first WSTK found is used if None.
+            Pass it in when more than one jig is connected otherwise the wrong WSTK may be opened.
+        '''
         try:
-            self.wstk = getwstkport()
-            self.wstkser = "123"
+            self.wstk = wstk or getwstkport()
+            self.wstkser = wstkser
+            self.railtest = True    # False when the production application is driving the carrier instead of RailTest
             #self.wcom=None
             self.wcom = serial.Serial(self.wstk, timeout=3)
+            self.rail = None
             if DEBUG>5: print("WSTK COM Port={}".format(self.wstk))
-            self.sa = sa.tinySA()   # open the COM port to TinySA
+            self.sa = sa.tinySA(TINYSA_PORT)   # open the COM port to TinySA
             if DEBUG>5: print("TinySA COM Port={}".format(self.sa.dev), flush=True)
         except Exception as err:
             print("failed to open devices:",err)
             traceback.print_tb(err.__traceback__)
-            exit()
+            raise   # the calibration step fails - exit() would only end the jig thread
         
+    def UseAnalyzer(self, port):
+        ''' measure with the TinySA on port (IE: leased from the AnalyzerPool) '''
+        if port != self.sa.dev:
+            self.sa.close()
+            self.sa = sa.tinySA(port)
+            if DEBUG>5: print("TinySA COM Port={}".format(self.sa.dev), flush=True)
+
     @property
 
     def openwcom(self):
@@ -71,70 +286,76 @@ class ZG23CrystalCal:
                 self.wcom = serial.Serial(self.wstk, timeout=3)
             except:
                 print("Cal:Unable to open WSTK COM port")
-                sys.exit(1)
+                raise
 
     def closewcom(self):
         if self.wcom:
             self.wcom.close()
         self.wcom = None
+        self.rail = None
 
     def InitWstkCom(self):
         ''' Init WSTK COM port AFTER programming Railtest.
             Check that the right version is being used.
+            The version check is skipped when the application (with the RAIL test CLI) is driving the carrier.
         '''
         self.openwcom
         self.wcom.write("\n".encode())          # clear the buffer
-        time.sleep(0.5)                         # wait for the DUT to stabilize - otherwise get garbage characters from UART
-        self.wcom.reset_input_buffer()          # purge any characters already sent - typically the railtest boot message which also often includes garbage characters
+        time.sleep(UART_SETTLE)                 # wait for the DUT to stabilize - otherwise get garbage characters from UART
+        self.Rail().flush()                     # purge any characters already sent - typically the railtest boot message which also often includes garbage characters
+        if not self.railtest:
+            return
         txt=self.RailTestCmd("getversion")
         if txt == None:
-            raise("Unable to connect to RailTest - was it programmed properly?")
+            raise RailTest.RailTestError("Unable to connect to RailTest - was it programmed properly?")
         if DEBUG>5: print("RailTest Version =",txt)
         # TODO add an assert if the version is not the expected one
 
-    def RailTestCmd(self, cmd):
-        ''' Send RailTest Command in cmd, return the 2nd line of the command '''
-        #self.openwcom()
+    def Rail(self):
+        ''' the RailTestClient on the WSTK COM port '''
         self.openwcom
-        cmd2=cmd + "\n"
-        self.wcom.write(cmd2.encode())
-        txt=self.wcom.readline()   # 1st line is just an echo of the command
-        timeout=10
-        while cmd.encode() not in txt:       # skip over any garbage looking for the command
-            if DEBUG>8: print("cmd={}, not in response={}".format(cmd,txt)) 
-            txt=self.wcom.readline()
-            timeout -=1
-            if timeout==0: break
-        txt=self.wcom.readline()   # The line after the cmd echo should be the response if any
-        cmd1=cmd.split(' ',1)       # look for the 1st word of the string
-        if cmd1[0].encode() not in txt: 
-            print("Error - invalid response {} to command {}".format(txt,cmd))
+        if self.rail is None or self.rail.ser is not self.wcom:
+            self.rail = RailTest.RailTestClient(self.wcom)
+        return(self.rail)
+
+    def RailTestCmd(self, cmd):
+        ''' Send RailTest Command in cmd, return the response as a dict IE: {"CTUNEXIANA": "0x09b", "CTUNEXOANA": "0x0c3"} or None if it failed '''
+        rsp=self.RailTestCmds([cmd])
+        return(rsp[0] if rsp else None)
+
+    def RailTestCmds(self, cmds):
+        ''' Send several RailTest commands in one write, return the list of responses or None if any of them failed '''
+        try:
+            return(self.Rail().commands(cmds))
+        except RailTest.RailTestError as err:
+            print("Error - {}".format(err))
             return(None)
-        # TODO maybe try the command a 2nd time if it has failed?
-        return(txt.decode())
-        
+
     def getCtune(self):
         ''' Get the current DUT CTUNE value in RAM'''
-        txt=self.RailTestCmd("getctune")
-        if DEBUG>8: print(txt)
-        if "CTUNEXIANA:" in txt:
-            # CTUNE command response = {{(getctune)}{CTUNEXIANA:0x09b}{CTUNEXOANA:0x0c3}} - pick out the 0x09b which is the CTUNE value
-            ctune = txt[txt.find("0"):txt.find("}{CTUNEXO")]
-            ct = int(ctune,0)
+        rsp=self.RailTestCmd("getctune")
+        if DEBUG>8: print(rsp)
+        if rsp and "CTUNEXIANA" in rsp:
+            # CTUNE command response = {{(getctune)}{CTUNEXIANA:0x09b}{CTUNEXOANA:0x0c3}} - the 0x09b is the CTUNE value
+            ct = int(rsp["CTUNEXIANA"],0)
             if DEBUG>6: print("ctune={}".format(ct))
             return(ct)
         return None
 
     def setCtune(self, val):
-        self.RailTestCmd("rx 0")
-        self.RailTestCmd("setctune {}".format(val))
-
-    def TxToneInit(self):
-        ''' Setup RailTest to output a carrier wave at 908.42MHz'''
-        self.RailTestCmd("rx 0")
-        self.RailTestCmd("setzwavemode 1 3")
-        self.RailTestCmd("setzwaveregion 1") # US
-        self.RailTestCmd("setchannel 2") # 908.42MHz
+        self.RailTestCmds(["rx 0", "setctune {}".format(val)])
+
+    def TxToneInit(self, channel=2):
+        ''' Setup RailTest to output a carrier wave at 908.42MHz (channel 2) or 908.40MHz (channel 1)'''
+        self.RailTestCmds(["rx 0",
+            "setzwavemode 1 3",
+            "setzwaveregion 1",     # US
+            "setchannel {}".format(channel)])
+
+    def SetChannel(self, channel):
+        ''' move the carrier to another channel after Prepare() '''
+        self.RailTestCmd("setchannel {}".format(channel))
+        self.target = self.solver.target = CHANNEL_FREQ[channel]
         
     def TxToneOn(self):
         ''' turn on the carrier ''' 
@@ -146,60 +367,446 @@ class ZG23CrystalCal:
 
     def saInit(self):
         ''' Initialize the TinySA Spectrum Analyzer '''
-        self.sa.rbw(1) # 0=AUTO which typically picks 1K - could choose 3k which is faster but less accurate
+        self.sa.rbw(FIT_RBW if PEAK_ESTIMATOR == "FIT" else 1) # 0=AUTO which typically picks 1K - 3k is faster but needs the FIT estimator
         self.sa.send_command("spur off \r")  # turn spur off which speeds up scanning
-        self.sa.set_frequencies(START_FREQ, STOP_FREQ, POINTS_SCAN)
+        self.sa.set_frequencies(START_FREQ, STOP_FREQ, self.points)
         self.sa.set_sweep(START_FREQ,STOP_FREQ)
-        self.sa.send_scan(START_FREQ, STOP_FREQ,POINTS_SCAN) # start with a clean scan of the noise floor
+        self.sa.send_scan(START_FREQ, STOP_FREQ, self.points) # start with a clean scan of the noise floor
         #self.sa.set_high_input() # not needed with the TinySA Ultra - but it does have to be in Ultra mode which is done via the GUI
 
-    def CalibrateCrystal(self):
-        ''' Run the Crystal Calibration algorithm and return the calibrated CTUNE value or -1 if calibration fails
-            Typical CTUNE values are between 50 and 200 
+    @property
+    def points(self):
+        ''' points in the wide sweep for the PEAK_ESTIMATOR '''
+        return(FIT_POINTS_SCAN if PEAK_ESTIMATOR == "FIT" else POINTS_SCAN)
+
+    @property
+    def narrow_points(self):
+        return(FIT_NARROW_POINTS if PEAK_ESTIMATOR == "FIT" else NARROW_POINTS)
+
+    def Trace(self, name, start, stop, points):
+        ''' Run one scan and return the frequencies and levels of every point '''
+        with Metrics.Timer("sweep", name):
+            self.sa.send_scan(start, stop, points)
+            self.sa.set_frequencies(start, stop, points)
+            self.trace = (self.sa.frequencies, self.sa.data())    # kept for Harvest
+            return(self.trace)
+
+    def Sweep(self, name, start, stop, points):
+        ''' Run one scan and return [Frequency, level] of the peak - the scan returns once it is complete '''
+        if PEAK_ESTIMATOR != "FIT":
+            with Metrics.Timer("sweep", name):
+                self.sa.send_scan(start, stop, points)
+                return(self.sa.fetch_marker())
+        peak = SpectrumAnalysis.EstimatePeak(*self.Trace(name, start, stop, points))
+        if DEBUG>4: print("{} sweep {}".format(name, peak))
+        if peak.index in (0, points-1) and peak.snr >= SpectrumAnalysis.MIN_SNR:
+            return([peak.frequency, peak.level])    # on the edge like the marker - only good enough to move CTUNE towards it
+        if peak.confidence < MIN_PEAK_CONFIDENCE:
+            return(None)
+        return([peak.frequency, peak.level])
+
+    def MeasureCarrier(self, center=None, target=TARGET_FREQ):
+        ''' Sweep for the carrier and return [Frequency, level] of the peak or None.
+            center=None sweeps the full START_FREQ..STOP_FREQ window (moved to target) otherwise a narrow window around center.
+            A narrow sweep falls back to the wide one if the peak is on the edge of the window or too weak.
+        '''
+        wstart = START_FREQ-TARGET_FREQ+target
+        wstop = STOP_FREQ-TARGET_FREQ+target
+        if center is None or SWEEP_MODE == "WIDE":
+            return(self.Sweep("wide", wstart, wstop, self.points)) # typically takes 1.5s with the MARKER
+        center = max(wstart+NARROW_SPAN/2, min(wstop-NARROW_SPAN/2, center))
+        start = center-NARROW_SPAN/2
+        stop = center+NARROW_SPAN/2
+        freq=self.Sweep("narrow", start, stop, self.narrow_points)
+        edge = 2*NARROW_SPAN/(self.narrow_points-1)  # within 2 points of the edge the real peak may be outside the window
+        if freq == None or freq[1] <= MIN_RSSI_TXTONE or freq[0] < start+edge or freq[0] > stop-edge:
+            if DEBUG>2: print("carrier not in the narrow window {} - sweeping wide".format(freq))
+            freq=self.Sweep("wide", wstart, wstop, self.points)
+        return(freq)
+
+    def FindCarriers(self, targets):
+        ''' One wide sweep over the START_FREQ..STOP_FREQ windows of all the targets with every tone on.
+            Returns the PeakEstimates of up to one carrier per target, strongest first - which DUT is which is not known.
+        '''
+        spacing = (STOP_FREQ-START_FREQ)/(self.points-1)
+        start = min(targets)+START_FREQ-TARGET_FREQ
+        stop = max(targets)+STOP_FREQ-TARGET_FREQ
+        peaks = SpectrumAnalysis.EstimatePeaks(*self.Trace("pair wide", start, stop, int(round((stop-start)/spacing))+1), len(targets), PAIR_SEPARATION)
+        if DEBUG>4: print("pair wide sweep {}".format(peaks))
+        return([p for p in peaks if p.confidence >= MIN_PEAK_CONFIDENCE and p.level > MIN_RSSI_TXTONE])
+
+    def MeasureCarriers(self, expected):
+        ''' One sweep for several carriers expected at the frequencies listed - returns [Frequency, level] or None for each.
+            A carrier not found within PAIR_SEPARATION/2 of where it is expected is None so it can be measured on its own.
+        '''
+        spacing = NARROW_SPAN/(self.narrow_points-1)
+        start = min(expected)-NARROW_SPAN/2
+        stop = max(expected)+NARROW_SPAN/2
+        peaks = SpectrumAnalysis.EstimatePeaks(*self.Trace("pair", start, stop, int(round((stop-start)/spacing))+1), len(expected), PAIR_SEPARATION)
+        if DEBUG>4: print("pair sweep {}".format(peaks))
+        freqs = []
+        for e in expected:
+            near = [p for p in peaks if abs(p.frequency-e) < PAIR_SEPARATION/2 and p.confidence >= MIN_PEAK_CONFIDENCE]
+            freqs.append([near[0].frequency, near[0].level] if near else None)
+        return(freqs)
+
+    def Prepare(self, start=None):
+        ''' RailTest setup before the TinySA is needed - the carrier is on channel 2 and the first CTUNE is set.
+            start is the CTUNE to try first (IE: from the CtuneCache) instead of the average of the previous boards
         '''
         self.InitWstkCom()
-        initialCtune=self.getCtune()
+        self.initialCtune=self.getCtune()
         self.TxToneInit()
-        ctune=initialCtune
-        #ctune=initialCtune -20  # +/- 20 for debugging will force CTUNE to start off wrong and then it should converge
-        #self.setCtune(ctune)    # debug only with the line above
+        self.target = TARGET_FREQ
+        self.solver=CtuneSolver()
+        self.start = start
+        self.ctune=self.solver.first(self.initialCtune) if start is None else start
+        #self.ctune=self.initialCtune -20  # +/- 20 for debugging will force CTUNE to start off wrong and then it should converge
+        if self.ctune != self.initialCtune:
+            self.setCtune(self.ctune)
+        self.calibrated = False
+        self.done = None
+        self.trials = 0
+        self.trace = None
+        self.power = None       # dBm of the carrier in the last sweep
+        self.noise = None       # dBm noise floor from the sweep with the most points away from the carrier
+        self.noisepoints = 0
+        self.spur = None        # dBc of the highest spur in any sweep
+
+    def Expected(self):
+        ''' where the carrier should be at the current CTUNE or None if it is not known yet '''
+        predicted = self.solver.predict(self.ctune)
+        if predicted is None and self.start is not None:   # a cached CTUNE should already be on frequency
+            return(self.target)
+        return(predicted)
+
+    def Measured(self, freq):
+        ''' Record the [Frequency, level] measured at the current CTUNE (None if no carrier was found) and set the next CTUNE.
+            Returns True once calibrated.
+        '''
+        if freq != None:
+            if freq[1] > MIN_RSSI_TXTONE: # The signal strength has to be high or else just ignore the reading and try again
+                if MIN_FREQ-TARGET_FREQ < freq[0]-self.target < MAX_FREQ-TARGET_FREQ: # then done
+                    self.calibrated = True
+                    if self.start is None or self.trials > 1:  # a cached CTUNE that verified is already in the prior
+                        self.solver.done(self.ctune, freq[0])
+                    return(True)
+                self.ctune = self.solver.next(self.ctune, freq[0])
+                self.setCtune(self.ctune)
+            else:
+                if DEBUG>1: print("marker strength is low {}".format(freq[1]))
+        return(False)
+
+    def Harvest(self, freq, trace, carriers):
+        ''' Keep the carrier power, noise floor and worst spur of a sweep this DUT was measured in at no extra sweep time.
+            freq is the [Frequency, level] of the carrier of this DUT and carriers the frequencies of every carrier in the trace.
+        '''
+        if freq is None or trace is None or freq[1] <= MIN_RSSI_TXTONE:
+            return
+        self.power = freq[1]
+        spectrum = SpectrumAnalysis.MeasureSpectrum(*trace, carriers, SPUR_EXCLUSION)
+        if spectrum.points > self.noisepoints:  # a narrow sweep is mostly carrier - the widest one has the real noise floor
+            self.noise = spectrum.noise
+            self.noisepoints = spectrum.points
+        if spectrum.spur is not None and (self.spur is None or spectrum.spur-freq[1] > self.spur):
+            self.spur = spectrum.spur-freq[1]
+            if DEBUG>4: print("spur {:.1f}dBc at {:.0f}Hz".format(self.spur, spectrum.spur_freq))
+
+    def RF(self):
+        ''' the carrier power and spectrum harvested from the sweeps - None if not measured (IE: only narrow sweeps) '''
+        return({"tx_power": self.power, "noise_floor": self.noise, "spur_dbc": self.spur})
+
+    def Finish(self):
+        ''' Returns the calibrated CTUNE or -1 after returning the DUT to its original CTUNE if the calibration failed '''
+        ctune = self.ctune
+        if not self.calibrated:  # then calibration failed
+            self.setCtune(self.initialCtune) # return the DUT to the original ctune value in anticipation of trying again
+            if DEBUG>1: print("*** Calibration FAILED after {} trials ***".format(self.trials))
+            ctune = -1
+        elif DEBUG>1: print("CTUNE={} calibrated in {} trials".format(ctune, self.trials))
+        self.done = ctune
+        return(ctune)
+
+    def Run(self):
+        ''' Calibrate the DUT set up by Prepare() with the TinySA - returns the calibrated CTUNE value or -1 '''
         self.saInit()           # Initialize the TinySA
-        calibrated = False
         self.sa.pause() # make sure the SA is not scanning to run 1 scan and know when it has completed
-        self.sa.send_scan(START_FREQ, STOP_FREQ,POINTS_SCAN) # start with a clean scan of the noise floor
+        self.sa.send_scan(START_FREQ, STOP_FREQ, self.points) # start with a clean scan of the noise floor
         current_time = time.time()
 
         for trials in range(MAX_TRIALS): # usually takes less than this many tries to zero in on the proper value
+            self.trials += 1
             self.TxToneOn()  # turn on carrier wave out of DUT
-            self.sa.send_scan(START_FREQ, STOP_FREQ,POINTS_SCAN) # start a scan - returns once the scan is complete which typically takes 1.5s
-            freq=self.sa.fetch_marker() # returns the FREQ and the signal strength of the peak signal
+            self.trace = None
+            freq=self.MeasureCarrier(self.Expected(), self.target) # returns the FREQ and the signal strength of the peak signal
             self.TxToneOff()
-            if DEBUG > 1: print("ctune={} Freq={} in {:.2f}s".format(ctune,freq,time.time()-current_time), flush=True)
+            self.Harvest(freq, self.trace, [freq[0]] if freq else [])
+            if DEBUG > 1: print("ctune={} Freq={} in {:.2f}s".format(self.ctune,freq,time.time()-current_time), flush=True)
             current_time=time.time()
-            if freq != None:
-                if freq[1] > MIN_RSSI_TXTONE: # The signal strength has to be high or else just ignore the reading and try again
-                    if (freq[0] > MIN_FREQ) and (freq[0] < MAX_FREQ): # then done
-                        calibrated = True
-                        break
-                    else:
-                        delta = max(1,min(30,abs(int((TARGET_FREQ-freq[0])/1500)))) # limit the amount of change in ctune for each trial
-                        if freq[0] < TARGET_FREQ:
-                            ctune -=delta
-                        else:
-                            ctune +=delta
-                    self.setCtune(ctune)
-                else:
-                    if DEBUG>1: print("marker strength is low {}".format(freq[1]))
-
-        if not calibrated:  # then calibration failed
-            self.setCtune(initialCtune) # return the DUT to the original ctune value in anticipation of trying again
-            if DEBUG>1: print("*** Calibration FAILED ***")
-            ctune = -1
+            if self.Measured(freq):
+                break
 
+        ctune = self.Finish()
         self.sa.resume()
         self.closewcom
         return(ctune)
- 
+
+    def CalibrateCrystal(self, start=None):
+        ''' Run the Crystal Calibration algorithm and return the calibrated CTUNE value or -1 if calibration fails
+            Typical CTUNE values are between 50 and 200 
+            start is the CTUNE to try first (IE: from the CtuneCache) instead of the average of the previous boards
+        '''
+        self.Prepare(start)
+        return(self.Run())
+
+def CalibratePair(cals):
+    ''' Calibrate the DUTs of two ZG23CrystalCal already Prepare()d with the TinySA of the first one.
+        The second DUT must already be on the other channel (SetChannel) so while both carriers are where they are expected
+        and PAIR_SEPARATION apart one sweep measures both. On the first trial one wide sweep with both tones on finds
+        both carriers and a narrow sweep around the strongest one with only the first tone on tells them apart.
+        A carrier that is not found that way or is too close to the other one is measured with only its own tone on.
+        Returns the list of calibrated CTUNE values (-1 failed).
+    '''
+    sa = cals[0]
+    sa.saInit()
+    sa.sa.pause()
+    current_time = time.time()
+    for trials in range(MAX_TRIALS):
+        active = [cal for cal in cals if not cal.calibrated]
+        if not active:
+            break
+        for cal in active:
+            cal.trials += 1
+        expected = [cal.Expected() for cal in active]
+        freqs = [None]*len(active)
+        traces = [None]*len(active)
+        incarriers = [None]*len(active)     # every carrier in the trace of each DUT if there are more than its own
+        sa.trace = None
+        if len(active) == 2 and expected == [None, None]:   # first trial - one wide sweep for both carriers
+            for cal in active:
+                cal.TxToneOn()
+            found = sa.FindCarriers([cal.target for cal in active])
+            pairtrace = sa.trace
+            for cal in active:
+                cal.TxToneOff()
+            if len(found) == 2:
+                active[0].TxToneOn()    # is the strongest carrier the one of the first DUT?
+                sa.trace = None
+                freq = sa.Sweep("narrow", found[0].frequency-NARROW_SPAN/2, found[0].frequency+NARROW_SPAN/2, sa.narrow_points)
+                active[0].TxToneOff()
+                first = 0 if freq is not None and abs(freq[0]-found[0].frequency) < PAIR_SEPARATION/2 else 1
+                if first == 0:
+                    freqs[0], traces[0] = freq, sa.trace
+                else:
+                    freqs[0], traces[0], incarriers[0] = [found[1].frequency, found[1].level], pairtrace, [p.frequency for p in found]
+                freqs[1], traces[1], incarriers[1] = [found[1-first].frequency, found[1-first].level], pairtrace, [p.frequency for p in found]
+        elif len(active) > 1 and None not in expected and PAIR_SEPARATION <= max(expected)-min(expected) <= STOP_FREQ-START_FREQ:
+            for cal in active:
+                cal.TxToneOn()
+            freqs = sa.MeasureCarriers(expected)
+            if None not in freqs:   # a carrier that wasn't found would look like a spur to the other DUT
+                traces = [sa.trace]*len(active)
+                incarriers = [[f[0] for f in freqs]]*len(active)
+            for cal in active:
+                cal.TxToneOff()
+        for idx, cal in enumerate(active):
+            if freqs[idx] is None:  # on its own
+                cal.TxToneOn()
+                sa.trace = None
+                freqs[idx] = sa.MeasureCarrier(expected[idx], cal.target)
+                traces[idx] = sa.trace
+                cal.TxToneOff()
+        if DEBUG > 1: print("ctune={} Freq={} in {:.2f}s".format([cal.ctune for cal in active],freqs,time.time()-current_time), flush=True)
+        current_time=time.time()
+        for cal, freq, trace, carriers in zip(active, freqs, traces, incarriers):
+            cal.Harvest(freq, trace, carriers or ([freq[0]] if freq else []))
+            cal.Measured(freq)
+    sa.sa.resume()
+    return([cal.Finish() for cal in cals])
+
+class AnalyzerPool:
+    ''' The TinySAs of the station - Lease() hands a free one to a calibration and queues the calibration while they are all busy.
+        analyzers is the "analyzers" list of the station configuration (see Station.py):
+        [{"serial": "USB serial number", "port": "COM port", "jigs": ["LEFT", "RIGHT"]}, ...]
+        The port is found from the serial number if not given. jigs lists the jigs the analyzer can measure (all of them
+        if not given) - each analyzer must only hear the DUTs of its own jigs (IE: each group of jigs with its TinySA in
+        its own shielded enclosure) or the carrier of another DUT being calibrated may be measured instead.
+        An analyzer without a jigs list hears every DUT so it is never leased at the same time as another analyzer -
+        all the DUTs transmit on the same channel and each analyzer would fit the strongest carrier.
+        None uses TINYSA_PORT or every TinySA connected (one calibration at a time).
+    '''
+
+    def __init__(self, analyzers=None):
+        self.cond = threading.Condition()
+        self.analyzers = None if analyzers is None else [dict(a) for a in analyzers]
+        self.queue = []     # [jigs] of every Lease() waiting in the order they asked
+
+    def Discover(self):
+        ''' the analyzers with their ports - the TinySAs connected if none were listed '''
+        if self.analyzers is None:
+            if TINYSA_PORT is not None:
+                self.analyzers = [{"port": TINYSA_PORT}]
+            else:
+                self.analyzers = [{"serial": sn, "port": port} for sn, port in sa.getports()]
+            if DEBUG>2: print("TinySA analyzers: {}".format(", ".join(a["port"] for a in self.analyzers)))
+        for a in self.analyzers:
+            if not a.get("port"):
+                a["port"] = sa.getport(a["serial"])
+            a.setdefault("busy", False)
+        return(self.analyzers)
+
+    def Serves(self, *jigs):
+        ''' True if one analyzer can measure all the jigs '''
+        with self.cond:
+            return(any(self.CanMeasure(a, jigs) for a in self.Discover()))
+
+    def CanMeasure(self, analyzer, jigs):
+        return("jigs" not in analyzer or all(jig in analyzer["jigs"] for jig in jigs))
+
+    def Isolated(self, analyzer, analyzers):
+        ''' True if analyzer can measure while the busy analyzers do - only analyzers with their own jigs are isolated '''
+        busy = [a for a in analyzers if a["busy"]]
+        return(len(busy) == 0 or ("jigs" in analyzer and all("jigs" in a for a in busy)))
+
+    @contextmanager
+    def Lease(self, *jigs):
+        ''' with pool.Lease("LEFT") as port: ... - the COM port of a free analyzer that can measure all the jigs.
+            Waits for the first free analyzer - calibrations waiting for the same analyzers are served in order.
+        '''
+        start = time.time()
+        with self.cond:
+            analyzers = self.Discover()
+            if not any(self.CanMeasure(a, jigs) for a in analyzers):
+                raise OSError("No TinySA can measure {}".format(", ".join(jigs)))
+            ticket = [jigs]
+            self.queue.append(ticket)
+            try:
+                while True:
+                    ahead = [t[0] for t in self.queue[:next(i for i, t in enumerate(self.queue) if t is ticket)]]
+                    free = [a for a in analyzers if not a["busy"] and self.CanMeasure(a, jigs) and self.Isolated(a, analyzers)
+                            and not any(self.CanMeasure(a, other) for other in ahead)]
+                    if free:
+                        break
+                    self.cond.wait()
+            finally:
+                self.queue = [t for t in self.queue if t is not ticket]
+                self.cond.notify_all()
+            analyzer = free[0]
+            analyzer["busy"] = True
+        Metrics.Record("wait", "tinysa", start, time.time()-start)
+        if DEBUG>6: print("TinySA {} leased to {} after {:.2f}s".format(analyzer["port"], jigs, time.time()-start))
+        try:
+            yield(analyzer["port"])
+        finally:
+            with self.cond:
+                analyzer["busy"] = False
+                self.cond.notify_all()
+
+class CalPairing:
+    ''' Pairs up the jigs that reach the TinySA at about the same time so both DUTs are calibrated together by CalibratePair.
+        Each jig holds a Slot() from before it flashes RailTest so the first jig to reach the TinySA knows another one
+        is on its way and, if it is expected within PAIR_WAIT seconds from how long the jigs took to get there before,
+        waits up to PAIR_WAIT seconds for it. The second jig runs the calibration of both DUTs
+        while the first one waits for its result. Otherwise (or if CAL_PAIRING is off) the DUT is calibrated alone.
+    '''
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.preparing = []     # CalSlots of the jigs that haven't reached the TinySA yet
+        self.waiting = None     # the ZG23CrystalCal waiting for a partner
+        self.prepare_time = None    # seconds from taking a slot to reaching the TinySA - running average
+
+    @contextmanager
+    def Slot(self, jig):
+        ''' with pairing.Slot(jig) as slot: <flash RailTest> ctune = slot.Calibrate(cal, start, pool) '''
+        slot = CalSlot(self, jig)
+        with self.cond:
+            self.preparing.append(slot)
+        try:
+            yield(slot)
+        finally:
+            slot.release()
+
+    def Coming(self, cal, pool):
+        ''' number of the jigs expected at the TinySA within PAIR_WAIT that one analyzer of pool can measure together with cal '''
+        if self.prepare_time is None:   # nothing to go by yet
+            return(0)
+        soon = time.time() + PAIR_WAIT - self.prepare_time
+        return(sum(1 for slot in self.preparing if slot.since <= soon and pool.Serves(cal.jig, slot.jig)))
+
+    def Arrived(self, slot):
+        ''' slot reached the TinySA - called with cond held '''
+        took = time.time() - slot.since
+        self.prepare_time = took if self.prepare_time is None else 0.75*self.prepare_time + 0.25*took
+
+class CalSlot:
+    ''' one jig on its way to the TinySA - see CalPairing '''
+
+    def __init__(self, pairing, jig):
+        self.pairing = pairing
+        self.jig = jig
+        self.since = time.time()
+        self.held = True
+
+    def release(self):
+        ''' the jig is no longer on its way to the TinySA '''
+        with self.pairing.cond:
+            if self.held:
+                self.held = False
+                self.pairing.preparing.remove(self)
+                self.pairing.cond.notify_all()     # a jig waiting for this one can stop waiting
+
+    def Calibrate(self, cal, start, pool):
+        ''' Calibrate the DUT of cal with or without a partner - returns the calibrated CTUNE or -1.
+            The TinySA is leased from pool (an AnalyzerPool).
+        '''
+        pairing = self.pairing
+        cal.Prepare(start)      # RailTest setup doesn't need the TinySA
+        cal.partner = None
+        jig = cal.jig = self.jig
+        with pairing.cond:
+            pairing.Arrived(self)
+            self.release()
+            partner = pairing.waiting
+            if partner is not None and not pool.Serves(partner.jig, jig):   # no analyzer can measure both
+                partner = None
+            elif partner is not None:   # another jig is waiting - calibrate both
+                pairing.waiting = None
+                partner.partner = cal
+                pairing.cond.notify_all()
+            elif CAL_PAIRING and PEAK_ESTIMATOR == "FIT" and pairing.Coming(cal, pool) > 0:
+                pairing.waiting = cal
+                deadline = time.time() + PAIR_WAIT
+                while cal.partner is None and pairing.Coming(cal, pool) > 0 and time.time() < deadline:
+                    pairing.cond.wait(deadline-time.time())
+                if cal.partner is not None:
+                    while cal.done is None:     # the partner is calibrating both DUTs
+                        pairing.cond.wait()
+                    return(cal.done)
+                pairing.waiting = None
+        if partner is None:
+            with pool.Lease(jig) as port:
+                cal.UseAnalyzer(port)
+                return(cal.Run())
+        try:
+            cal.SetChannel(PAIR_CHANNELS[1])
+            partner.SetChannel(PAIR_CHANNELS[0])
+            with pool.Lease(partner.jig, jig) as port:
+                partner.UseAnalyzer(port)
+                if DEBUG>2: print("Calibrating 2 DUTs together")
+                return(CalibratePair([partner, cal])[1])
+        finally:
+            with pairing.cond:
+                if partner.done is None:    # the calibration failed with an exception
+                    partner.done = -1
+                pairing.cond.notify_all()
+
+_pairing = CalPairing()
+
+def GetPairing():
+    ''' the CalPairing shared by all the jigs '''
+    return(_pairing)
+
 if __name__ == "__main__":
     wstk=ZG23CrystalCal()
     
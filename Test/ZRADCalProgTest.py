@@ -9,6 +9,7 @@
     Typically they just press enter when the next DUT is ready and a PASS/FAIL is printed along with a QR code label.
 
     Recommendation is to call this script with a shell that assigns LCOM, RCOM, LSER and RSER.
+    Stations with more than two jigs list them in a JSON file passed as STATION=station.json (see Station.py).
 
     Several of the variables just below here may need to be customized for a specific test station.
 
@@ -29,9 +30,17 @@ import serial
 import time
 import sys, os, subprocess
 import traceback
+import threading
+import queue
 from packaging import version   # for comparing version numbers
 from SmartStartQR import *
 from serial.tools import list_ports
+import Station
+import Metrics
+import ResultsDB
+import Commander
+import PrintSpooler
+import SmartStartPayload
 from PIL import Image
 import ZG23CrystalCal
 import zpl        # Zebra ZPL creation library - convert the PNG to ZPL
@@ -42,6 +51,13 @@ import zebra      # Zebra label printer library - send the ZPL code to the print
 CURRENT_MIN = 5.0
 CURRENT_MAX = 10.0
 
+# RF limits checked with the carrier measured during the crystal calibration sweeps - no extra test time.
+# The power is at the TinySA antenna so it depends on the distance to the jig - set these from the first production lot.
+TX_POWER_MIN = -15.0    # dBm - typically -8 with the DUT within 1 foot of the TinySA
+TX_POWER_MAX = 0.0
+NOISE_FLOOR_MAX = -60.0 # dBm at RBW 3kHz - the TinySA itself is about -95
+SPUR_MAX_DBC = -40.0    # highest level more than ZG23CrystalCal.SPUR_EXCLUSION from the carrier relative to the carrier
+
 DEBUG = 5   # print debug messages - the higher the value, the more details are printed
 
 # USB IDs for a WSTK to open the serial port to RailTest
@@ -58,80 +74,148 @@ RAILTEST_FILENAME = "../Software/railtest_ZG23_442.s37"
 EXPECTED_SE_VERSION = "2.2.6"
 SECURE_ENGINE_FILENAME = "../Software/s2c3_se_fw_upgrade_app_2v2p6.hex"
 
+# How the DUT transmits the carrier for crystal calibration:
+# "RAILTEST"    - flash RailTest, calibrate, then flash the application over it (two full flash cycles per fresh DUT)
+# "APPLICATION" - flash the application first and drive the carrier with it so each DUT is flashed only once.
+#                 The application MUST be built with the RAIL test CLI on the VCOM answering the same commands
+#                 as RailTest (getctune, setctune, setchannel, SetTxTone...) - the stock ZRAD_ED.s37 does not.
+CAL_MODE = "RAILTEST"
+
 # path and executable to silabs commander
 CMDR = "C:/SiliconLabs/SimplicityStudio/v5/developer/adapter_packs/commander/commander.exe"
 
+# "ZPL" sends the labels to the printer as ZPL built directly from the QR code string (see SmartStartQR.SS_ZPL)
+# "PNG" renders qrProd.png/qrPack.png and converts the images to ZPL graphics - slower but matches the PNG files exactly
+LABEL_MODE = "ZPL"
+
 # for debugging - skip the label printing when True, normally False
 #SKIP_PRINTING = True
 SKIP_PRINTING = False
 
+# The per-DUT steps as a dependency graph - each step is a method, the shared station resources (see Station.py)
+# it holds while it runs and the steps that must have passed before it starts. A step starts as soon as its
+# dependencies pass so the host only steps run while Commander is busy with the DUT.
+# The steps that talk to the DUT form a single chain since there is only one debug connection to it.
+# CalibrateCrystal only leases a TinySA while the analyzer is measuring so flashing RailTest overlaps the other jigs.
+PIPELINE = [
+    ("ProbeDevice", (), ()),                                    # 0) read the SE version, lock, CTUNE and unique ID of the DUT once
+    ("ProgramSecureEngine", (), ("ProbeDevice",)),              # 1) check SE and update if needed
+    ("CalibrateCrystal", (), ("ProgramSecureEngine",)),         # 2) Check Crystal calibration and calibrate if needed
+    ("FlashApplication", (), ("CalibrateCrystal",)),            # 3) Flash the application, bootloader and keys
+    ("QuickFunctionalTest", (), ("FlashApplication",)),         # 4) Quick Functional Test
+    ("ReadQRCode", (), ("QuickFunctionalTest",)),               # 5) read the SmartStart QR code from the DUT
+    ("LockDebugPort", (), ("ReadQRCode",)),                     # 6) Lock the debug port
+    ("PrintLabels", ("printer",), ("ReadQRCode", "PrepareLabels")),  # queue the labels with the print spooler while the DUT is locked - the PNG files are shared too in PNG mode
+    ("PrepareLabels", (), ()),                                  # host: load the PNG label template - a no-op in ZPL mode
+    ("LoadHistory", (), ("ProbeDevice",)),                      # host: previous results of this chip
+    ]
+
+# Readiness polling instead of fixed delays - seconds
+POLL_INTERVAL = 0.25
+SE_UPGRADE_TIMEOUT = 10     # the SE upgrade takes about 2s to update flash and boot (AN1222)
+BOOT_TIMEOUT = 5            # application boot and DSK computed
+LOCK_TIMEOUT = 5
+
+def WaitFor(ready, timeout, interval=None):
+    ''' Poll ready() every interval (POLL_INTERVAL) seconds until it returns a true value or timeout seconds have passed
+        - returns the last value. Commander failing while the DUT is still booting counts as not ready.
+    '''
+    if interval is None:
+        interval = POLL_INTERVAL
+    deadline = time.time() + timeout
+    while True:
+        try:
+            value = ready()
+        except (Commander.CommanderError, subprocess.CalledProcessError):
+            value = None
+        if value or time.time() >= deadline:
+            return(value)
+        time.sleep(interval)
+
 class ZRADCalProgTest:
     ''' Top level python script for testing the ZRADMini '''
 
-    def __init__(self):
-        self.wstk = ["COM4", None]  # typically 2 WSTKs are used to test one while the other is being clamped into the jig
-        self.wstkser = ["440263534", "456"]
-        try:
-            for i in sys.argv:
-                if "LCOM" in i:                     # See USAGE for details
-                    self.wstk[0] = i.split('=')[1]
-                elif "RCOM" in i:
-                    self.wstk[1] = i.split('=')[1]
-                elif "LSER" in i:
-                    self.wstkser[0] = i.split('=')[1]
-                elif "RSER" in i:
-                    self.wstkser[1] = i.split('=')[1]
-            self.wcom=None
-        except Exception as err:
-            print("failed to open devices:",err)
-            traceback.print_tb(err.__traceback__)
-            exit()
-        
+    def __init__(self, jig, sched, side=0):
+        ''' jig is one entry of the station configuration - see Station.py
+            sched is the ResourceScheduler shared by all the jigs of the station
+        '''
+        self.side = side            # index of the jig in the station - each jig has its own instance so they all run at the same time
+        self.name = jig["name"]
+        self.arrow = jig["arrow"]
+        self.wstkser = jig["ser"]   # serial number of the WSTK for Commander
+        self.wstk = jig.get("com") or ZG23CrystalCal.getwstkport(self.wstkser)  # serial COM port of the WSTK for RailTest
+        self.cmdr = Commander.GetCommander(self.wstkser, CMDR)
+        self.sched = sched
+        self.zeb = None
+        self.wcom = None
+        self.qr = None              # SmartStart QR code string of the last DUT
+        self.payload = None         # SmartStartPayload of the last DUT
+        self.uid = None             # unique ID (serial number) of the last DUT if known
+        self.spooler = None         # PrintSpooler shared by all the jigs
+        self.results = None         # ResultsDB shared by all the jigs - None does not save the results
+        self.analyzers = None       # ZG23CrystalCal.AnalyzerPool shared by all the jigs
+        self.result = {}            # results of the DUT being tested - see ResultsDB.COLUMNS
+        self.appFlashed = False     # set when the application was already flashed into this DUT for calibration
+        self.state = None           # Commander.DeviceState of the DUT in the jig - None until it is probed
+
     @property
 
     def openwcom(self):
         if self.wcom is None:
             try:
-                self.wcom = serial.Serial(self.wstk[self.side], timeout=3)
+                self.wcom = serial.Serial(self.wstk, timeout=3)
             except:
                 print("Unable to open WSTK COM port")
-                exit()
+                raise   # fails the step - never exit() from a jig thread
 
     def closewcom(self):
         if self.wcom:
             self.wcom.close()
         self.wcom = None
 
-    def GetSEFirmwareVersion(self):
-        ''' Return the version of the Secure Engine in the EFR32 chip as a Bytes array Ex: "2.1.0" '''
-        rtn=subprocess.check_output(CMDR + " security status -d EFR32ZG23 --s {}".format(self.wstkser[self.side]),shell=True)
-        if "SE Firmware" not in rtn.decode():
-            print("SE firmware version get failed:\n\r{}\n\r".format(rtn))
+    def ProbeDevice(self):
+        ''' Read the state of the DUT just inserted - a locked DUT is reset to factory fresh
+            Returns True if OK, False if Commander can't talk to the DUT
+        '''
+        try:
+            self.state = Commander.Probe(self.cmdr, APPLICATION_FILENAME)
+            if self.state.debug_locked:     # if the DUT is locked, unlock it which also resets to factory fresh
+                if DEBUG>6: print("DUT locked - unlocking")
+                self.FactoryFresh()
+                self.state = Commander.Probe(self.cmdr, APPLICATION_FILENAME)
+        except (Commander.CommanderError, subprocess.CalledProcessError) as err:
+            print(err)
+            self.state = None
             return(False)
-        seVer = rtn.decode().split('\r')
-        seVer2 = seVer[0].split(' ')[-1]
-        for i in seVer:                 # if the DUT is locked, unlock it which also resets to factory fresh
-            if "Debug lock" in i:
-                if DEBUG>6: print("DUT locked - unlocking") 
-                if "Enabled" in i:
-                    self.FactoryFresh()
-                break
-        return(seVer2)
+        if DEBUG>6: print(self.state)
+        self.uid = self.state.uid
+        self.result["se_version"] = self.state.se_version
+        return(True)
+
+    def State(self):
+        ''' the DeviceState - probed now if it wasn't yet (IE: a single step run from the console) '''
+        if self.state is None and not self.ProbeDevice():
+            raise Commander.CommanderError("Unable to read the state of the DUT")
+        return(self.state)
 
     def ProgramSecureEngine(self):
         ''' Check the SE version and update if out of date 
             Returns True if OK, False if it fails
         '''
         startSEupdate = time.time()
-        seVer2=self.GetSEFirmwareVersion()
+        seVer2=self.State().se_version
         if version.parse(EXPECTED_SE_VERSION) > version.parse(seVer2): # SE needs to be updated
             if DEBUG>4: print("Updating SE firmware from {} to {}".format(seVer2,EXPECTED_SE_VERSION))
-            rtn=subprocess.check_output(CMDR + " flash --masserase -d EFR32ZG23 {} --s {}".format(SECURE_ENGINE_FILENAME,self.wstkser[self.side]),shell=True)
-            time.sleep(2) # Per the AN1222 App note, wait 2s for the SE to update flash and boot
-            seVer2=self.GetSEFirmwareVersion()
-            if seVer2==False or version.parse(EXPECTED_SE_VERSION) != version.parse(seVer2):
+            self.cmdr.Flash(SECURE_ENGINE_FILENAME, masserase=True)
+            def upgraded():
+                seVer = self.cmdr.SecurityStatus().se_version
+                return(seVer if version.parse(EXPECTED_SE_VERSION) == version.parse(seVer) else None)
+            seVer2=WaitFor(upgraded, SE_UPGRADE_TIMEOUT)  # the SE updates flash and boots after the upgrade app is flashed
+            if seVer2 is None:
                 print("FAILED to update SE version")
                 return(False)
+            self.State().se_version = seVer2
+            self.State().app_matches = False  # the mass erase removed the application
             if DEBUG>4: print("SE firmware updated in {}s".format(time.time() - startSEupdate))
         elif version.parse(EXPECTED_SE_VERSION) != version.parse(seVer2):
             if DEBUG>2:print("***NOTE*** SE version is NEWER {} than the expected version {}. The application firmware may need to be updated!".format(seVer2,EXPECTED_SE_VERSION))
@@ -142,10 +226,9 @@ class ZRADCalProgTest:
     def FlashRailTest(self):
         if DEBUG>7: print("Flashing RailTest start")
         # Flash RailTest into the DUT to prepare for calibration
-        rtn=subprocess.check_output(CMDR + " flash -d EFR32ZG23 {} --s {}".format(RAILTEST_FILENAME,self.wstkser[self.side]),shell=True)
-        if "completed successfully" not in rtn.decode():
+        self.State().app_matches = False   # RailTest replaces the application
+        if not self.cmdr.Flash(RAILTEST_FILENAME):
             print("Flashing RailTest failed")
-            print(rtn)
             return(False)
         if DEBUG>7: print("Flashing RailTest complete")
         return(True)
@@ -154,40 +237,84 @@ class ZRADCalProgTest:
         '''Check if CTUNE is set, if not, run calibration #################### 
             Returns True if OK, False if it fails
         '''
-        rtn=subprocess.check_output(CMDR + " ctune get -d EFR32ZG23 --s {}".format(self.wstkser[self.side]), shell=True)
-        cal1 = rtn.decode().split('\r')
-        if DEBUG>9: print("Cal={}".format(cal1))
-        for idx in range(len(cal1)):
-            if "Token" in cal1[idx]:
-                if "Not" in cal1[idx]:
-                    if not self.FlashRailTest():
-                        return(False)
-                    cal=ZG23CrystalCal.ZG23CrystalCal()
-                    cal.wstk=self.wstk[self.side]
-                    cal.wstkser=self.wstkser[self.side]
-                    ctune=cal.CalibrateCrystal()
-                    if ctune<=0:    # CTUNE failed
-                        return(False)
-                    rtn=subprocess.check_output(CMDR + " ctune set --value {} -d EFR32ZG23 --s {}".format(ctune, self.wstkser[self.side]), shell=True)
-                    if DEBUG>9: print(rtn)
-                    cal.closewcom
-                else: # already calibrated so skip this part - The crystal can be recalibrated by running the calibation script
-                    if DEBUG>7: print("Crystal Cal={}".format(cal1[idx][1:]))
-                    break
+        ctune=self.State().ctune
+        if ctune is not None: # already calibrated so skip this part - The crystal can be recalibrated by running the calibation script
+            if DEBUG>7: print("Crystal Cal={}".format(ctune))
+            self.result["ctune"] = ctune
+            self.result["trials"] = 0
+            return(True)
+        cache = ZG23CrystalCal.GetCtuneCache()
+        cached = cache.get(self.uid) if self.uid else None
+        if cached is not None and not ZG23CrystalCal.CTUNE_CACHE_VERIFY:  # board was calibrated before - restore it
+            if DEBUG>2: print("Restoring CTUNE={} calibrated before".format(cached))
+            self.cmdr.CtuneSet(cached)
+            self.state.ctune = cached
+            self.result["ctune"] = cached
+            self.result["trials"] = 0
+            return(True)
+        with ZG23CrystalCal.GetPairing().Slot(self.name) as slot:  # a jig already at the TinySA waits for this one to calibrate both DUTs together
+            if CAL_MODE == "APPLICATION":
+                if not self.FlashApplication():     # the application drives the carrier so it only has to be flashed once
+                    return(False)
+                self.appFlashed = True
+            elif not self.FlashRailTest():
+                return(False)
+            cal=ZG23CrystalCal.ZG23CrystalCal(self.wstk, self.wstkser)
+            cal.railtest = CAL_MODE != "APPLICATION"
+            try:    # waits for a free TinySA - with only one calibration is serialized across the jigs unless 2 of them are paired up
+                ctune=slot.Calibrate(cal, cached, self.analyzers)   # a cached CTUNE normally passes on the first sweep
+            finally:
+                cal.closewcom()
+                cal.sa.close()
+        self.result["trials"] = cal.trials
+        if ctune<=0:    # CTUNE failed
+            return(False)
+        if not self.CheckRF(cal.RF()):  # not saved in the DUT or the cache so a re-test is fully swept again
+            return(False)
+        rtn=self.cmdr.CtuneSet(ctune)
+        if DEBUG>9: print(rtn)
+        self.result["ctune"] = ctune
+        self.state.ctune = ctune
+        if self.uid:
+            cache.put(self.uid, ctune)
+        if self.appFlashed:
+            self.cmdr.DeviceReset()     # reboot so the application picks up the calibrated CTUNE token
+        return(True)
+
+    def CheckRF(self, rf):
+        ''' Check the carrier power, noise floor and spurs harvested from the calibration sweeps against the limits.
+            A value that wasn't measured (None) is not checked. Returns True if OK, False if the DUT fails
+        '''
+        self.result.update(rf)
+        failed = []
+        if rf["tx_power"] is not None and not (TX_POWER_MIN <= rf["tx_power"] <= TX_POWER_MAX):
+            failed.append("TX power {:.1f}dBm, Min={}, Max={}".format(rf["tx_power"], TX_POWER_MIN, TX_POWER_MAX))
+        if rf["noise_floor"] is not None and rf["noise_floor"] > NOISE_FLOOR_MAX:
+            failed.append("noise floor {:.1f}dBm, Max={}".format(rf["noise_floor"], NOISE_FLOOR_MAX))
+        if rf["spur_dbc"] is not None and rf["spur_dbc"] > SPUR_MAX_DBC:
+            failed.append("spur {:.1f}dBc, Max={}".format(rf["spur_dbc"], SPUR_MAX_DBC))
+        if failed:
+            print("*** FAILED *** - DUT failed RF test. {}".format(", ".join(failed)))
+            return(False)
+        if DEBUG>7: print("RF test passed - {}".format(rf))
         return(True)
 
     def FlashApplication(self):
         ''' Flash the application which includes the bootloader and keys'''
+        if self.appFlashed:     # already flashed during calibration
+            if DEBUG>7: print("Application already flashed")
+            return(True)
+        if self.State().app_matches:    # re-test of a DUT that already has this application
+            if DEBUG>2: print("Application already in flash")
+            return(True)
         startprogram = time.time()
         if DEBUG>2: print("Flashing Application start",flush=True)
-        rtn=subprocess.check_output(CMDR + " flash -d EFR32ZG23 {} --s {}".format(APPLICATION_FILENAME,self.wstkser[self.side]),shell=True)
-        if "completed successfully" not in rtn.decode():
+        if not self.cmdr.Flash(APPLICATION_FILENAME):
             print("Flashing Application failed")
-            print(rtn)
             return(False)
+        self.state.app_matches = True
         if DEBUG>2: print("Flashing Application complete in {} seconds".format(round(time.time()-startprogram,2)),flush=True)
-        time.sleep(0.5) # wait for the chip to boot and compute the DSK 
-        return(True)
+        return(True)    # ReadQRCode waits for the chip to boot and compute the DSK
 
     def SendWcom(self,cmd):
         ''' Send a serial command to the application '''
@@ -198,46 +325,68 @@ class ZRADCalProgTest:
 
     def QuickFunctionalTest(self):
         ''' quick check of the voltage/current - if outside of the expected norm, fail the DUT '''
-        aem=subprocess.check_output(CMDR+ " aem measure --windowlength 200 --s {}".format(self.wstkser[self.side]),shell=True)
-        mA1 = aem.decode().split('\r')
-        for i in range(len(mA1)):
-            if "mA" in mA1[i]:
-                mA2=mA1[i]
-                break
-        mA3=mA2.split(' ')
-        mA = float(mA3[2])
+        mA=self.cmdr.AemMeasure(200)
+        self.result["current"] = mA
         if (mA < CURRENT_MIN) or (mA > CURRENT_MAX):
             print("*** FAILED *** - DUT failed current test. Measured {}mA, Min={},Max{}".format(mA,CURRENT_MIN,CURRENT_MAX))
             return(False)
         #self.SendWcom("RED ON") - this doesn't work and locks up the WCOM port on the 2nd pass
-        if DEBUG>7: print("Functional Test passed - DUT={}mA".format(mA3[2]))
+        if DEBUG>7: print("Functional Test passed - DUT={}mA".format(mA))
         return(True)
 
-    def CreateQRImages(self):
+    def ReadQRCode(self):
+        ''' Read the SmartStart QR code computed by the DUT - polls until the application has booted and computed the DSK '''
         if DEBUG>7: print("Get QR code")
-        rtn=subprocess.check_output(CMDR + " device zwave-qrcode -d EFR32ZG23 --timeout 1000 --s {}".format(self.wstkser[self.side]),shell=True)
-        qr1 = rtn.decode().split('\r')
-        qr2=""
-        for i in range(len(qr1)): 
-            if "QR code" in qr1[i]: 
-                qr2=qr1[i]
+        deadline = time.time() + BOOT_TIMEOUT
+        while True:
+            try:
+                qr4=self.cmdr.ZwaveQRCode(1000)
+                if DEBUG>5: print("QR Code={}".format(qr4))
+                self.payload = SmartStartPayload.Parse(qr4)
                 break
-        qr3 = qr2.split(' ')
-        qr4=""
-        for i in range(len(qr3)):
-            if "90" in qr3[i]:
-                qr4=qr3[i]
-        if DEBUG>5: print("QR Code={}".format(qr4))
-        SmartStartQR.SS_QRGen(qr4)  # convert the QR Code from the DUT into images to be printed
+            except (Commander.CommanderError, subprocess.CalledProcessError,   # still booting - same as WaitFor
+                    SmartStartPayload.PayloadError) as err:     # never print a label that can't be scanned
+                if time.time() >= deadline:
+                    print("***ERROR*** {} QR code from the DUT is unreadable or invalid: {}".format(self.name, err))
+                    self.qr = None
+                    return(False)
+            time.sleep(POLL_INTERVAL)
+        self.qr = qr4
+        self.result["qr"] = qr4
+        self.result["dsk"] = self.payload.dsk
+        return(True)
+
+    def CreateQRImages(self):
+        if not self.ReadQRCode():
+            return(False)
+        if LABEL_MODE == "PNG":
+            SmartStartQR.SS_QRGen(self.qr)  # convert the QR Code from the DUT into images to be printed
+        return(True)
+
+    def PrepareLabels(self):
+        ''' host only - load the label template (fonts and logo) while the DUT is being programmed.
+            Nothing to do in ZPL mode - the printer draws the QR code and recalls the logo stored by zeb_init.
+        '''
+        if LABEL_MODE == "PNG":
+            SmartStartQR.Template()
+        return(True)
+
+    def LoadHistory(self):
+        ''' host only - look up the previous tests of this chip in the results database '''
+        if self.results is None or self.uid is None:
+            return(True)
+        history = self.results.History(self.uid)
+        if len(history) > 0 and DEBUG>1:
+            last = history[0]
+            print("{} DUT was tested {} times before - last {}".format(self.name, len(history),
+                "PASSED" if last["passed"] else "FAILED at {}".format(last["fail_step"])))
+        return(True)
 
     def LockDebugPort(self):
         ''' Lock the debug port - requires a full device erase to be able to reprogram or debug DUT - See AN1222 for details'''
-        rtn=subprocess.check_output(CMDR + " security lock --device EFR32ZG23 --s {}".format(self.wstkser[self.side]),shell=True)
-        time.sleep(0.5) # wait for the lock to complete
-        rtn=subprocess.check_output(CMDR + " security status --device EFR32ZG23 --s {}".format(self.wstkser[self.side]),shell=True)
-        lock=rtn.decode().split('\r')[2]
-        if "Enabled" not in lock:
-            print("\r\n***FAILED to lock debug port***\r\n{}".format(rtn))  
+        self.cmdr.SecurityLock()
+        if not WaitFor(lambda: self.cmdr.SecurityStatus().debug_locked, LOCK_TIMEOUT):
+            print("\r\n***FAILED to lock debug port***\r\n")
             return(False)
         if DEBUG>9: print("Debug Port Locked")
         return(True)
@@ -246,10 +395,11 @@ class ZRADCalProgTest:
         ''' Clear ALL flash in the DUT to be Factory Fresh and unlock the debug port to allow it to be reprogrammed
             Note that the SE is a one-way upgrade so there is no way to set it back to Factory Fresh
         '''
-        rtn=subprocess.check_output(CMDR + " device unlock -d EFR32ZG23 --s {}".format(self.wstkser[self.side]), shell=True) # this also runs a masserase
-        if DEBUG>7: print("Unlock=" + rtn.decode())
-        rtn=subprocess.check_output(CMDR + " device pageerase --region @userdata -d EFR32ZG23 --s {}".format(self.wstkser[self.side]), shell=True) # erases Z-Wave tokens, crystal cal, etc
-        if DEBUG>7: print("UserData=" + rtn.decode())
+        rtn=self.cmdr.DeviceUnlock() # this also runs a masserase
+        if DEBUG>7: print("Unlock=" + rtn)
+        rtn=self.cmdr.PageErase("@userdata") # erases Z-Wave tokens, crystal cal, etc
+        if DEBUG>7: print("UserData=" + rtn)
+        self.state = None   # everything but the SE was erased
         if DEBUG>1: print("DUT reset to Factory new")
 
     def zeb_init(self):
@@ -261,26 +411,112 @@ class ZRADCalProgTest:
             if "ZPL" in zz: zp = zz
         if zp == None:
             raise OSError("Zebra Printer not found") # TODO - on Windows this will never happen since once the printer driver is installed then ZP is ZDesigner ZD411-300dpi
-            time.sleep(5)   # TODO want a way to test that the printer is actually connected and ready to print but haven't found one yet...
-            sys.exit(1)
         self.zeb.setqueue(zp)
-
-    def zeb_print(self):
-        ''' print the labels '''
+        ready, reason = PrintSpooler.PrinterStatus(zp)
+        if not ready:
+            print("***WARNING*** Label printer {} is not ready: {} - labels will be queued until it is".format(zp, reason))
+        setup = SmartStartQR.SS_LogoZPL() if LABEL_MODE == "ZPL" else None  # store the logo in the printer instead of sending it with every label
+        self.spooler = PrintSpooler.PrintSpooler(self.zeb, setup=setup).start()  # prints in the background so a slow printer never stalls the jigs
+
+    def LabelZPL(self):
+        ''' ZPL for the package and product labels of the last DUT '''
+        if LABEL_MODE == "ZPL":
+            prod, pack = SmartStartQR.SS_ZPL(self.qr)
+            return(pack + prod)    # one print job for both labels
         l = zpl.Label(25.4*4,12.7*4,12) # 1x0.5" at 300dpi
         l.origin(17,0)
         i=Image.open('qrPack.png')
         if DEBUG>7: print(i.size[0], i.size[1])
         imageHeight = l.write_graphic(i,16)
         l.endorigin()
-        self.zeb.output(l.dumpZPL())
+        out = l.dumpZPL()
         l = zpl.Label(25.4*4,12.7*4,12) # 1x0.5" at 300dpi
         l.origin(14,0)
         i=Image.open('qrProd.png')
         if DEBUG>7: print(i.size[0], i.size[1])
         imageHeight = l.write_graphic(i,22) # 2nd arg is width in mm
         l.endorigin()
-        self.zeb.output(l.dumpZPL())
+        return(out + l.dumpZPL())
+
+    def zeb_print(self):
+        ''' queue the labels with the print spooler - they are printed in the background '''
+        self.spooler.Enqueue(self.LabelZPL(), self.qr, self.uid)
+
+    def PrintLabels(self):
+        ''' generate the QR code images and print them unless printing is turned off '''
+        if self.qr is None and not self.ReadQRCode():
+            return(False)
+        if LABEL_MODE == "PNG":
+            SmartStartQR.SS_QRGen(self.qr)  # convert the QR Code from the DUT into images to be printed
+        if not SKIP_PRINTING:
+            self.zeb_print()
+        return(True)
+
+    def TestDUT(self):
+        ''' Run the full calibrate, program, test and print sequence (PIPELINE) on the DUT in this jig
+            Returns True if the DUT passed, False if any step failed
+        '''
+        dutstarttime = time.time()
+        self.appFlashed = False
+        self.uid = None
+        self.state = None   # new DUT - ProbeDevice reads its state
+        self.qr = None
+        Metrics.SetJig(self.name)
+        self.result = {"time": dutstarttime, "jig": self.name, "wstkser": self.wstkser, "steps": {}}
+        print("Testing {}".format(self.name), flush=True)
+        names = set(step for step, resources, after in PIPELINE)
+        pending = list(PIPELINE)
+        passed = set()
+        failed = None
+        running = 0
+        finished = queue.Queue()
+        while (pending and failed is None) or running:
+            for entry in list(pending):
+                step, resources, after = entry
+                if failed is None and all(a in passed or a not in names for a in after):    # a step removed from PIPELINE counts as passed
+                    pending.remove(entry)
+                    running += 1
+                    threading.Thread(target=self.RunStep, args=(step, resources, finished), daemon=True).start()
+            if running == 0:    # nothing can run - the dependencies of the pending steps can never pass
+                failed = failed or pending[0][0]
+                break
+            step, ok = finished.get()
+            running -= 1
+            if ok:
+                passed.add(step)
+            elif failed is None:    # skip the rest - typically re-seat or replace the DUT
+                failed = step
+        if failed is not None:
+            Metrics.Record("dut", failed, dutstarttime, time.time()-dutstarttime, False)  # name is the step that failed
+            self.SaveResult(False, failed)
+            return(False)
+        Metrics.Record("dut", "PASSED", dutstarttime, time.time()-dutstarttime)
+        self.SaveResult(True)
+        print("\n\r\n\r{} DUT PASSED {}{}{} in {} seconds\n\r".format(self.name,self.arrow,self.arrow,self.arrow,round(time.time()-dutstarttime,0)))
+        return(True)
+
+    def RunStep(self, step, resources, finished):
+        ''' run one PIPELINE step in its own thread and put (step, passed) in the finished queue '''
+        Metrics.SetJig(self.name)
+        ok = False
+        start = time.time()
+        try:
+            with Metrics.Timer("step", step) as t:    # includes the wait for the shared resources
+                with self.sched.use(*resources):
+                    t.ok = ok = getattr(self, step)()
+        except Exception as err:
+            print("\n\r*** {} {} error: {}".format(self.name, step, err))
+            traceback.print_tb(err.__traceback__)
+        finally:    # whatever is raised TestDUT must not wait for this step forever
+            self.result["steps"][step] = round(time.time()-start, 2)
+            finished.put((step, ok))
+
+    def SaveResult(self, passed, fail_step=None):
+        ''' queue the results of the DUT to be written to the results database '''
+        if self.results is None:
+            return
+        self.result.update(passed=passed, fail_step=fail_step, uid=self.uid, duration=time.time()-self.result["time"])
+        self.results.Add(self.result)
 
     def usage():
         print("Usage: python ZRADCalProgTest.py LCOM=COMxx RCOM=COMxx LSER=yyyyy RSER=yyyyy")
@@ -288,6 +524,7 @@ class ZRADCalProgTest:
         print("RCOMxx is the serial COM port to the Right WSTK for use by Railtest")
         print("LSER=yyyyyy is the serial number of the Left WSTK needed by Commander")
         print("RSER=yyyyyy is the serial number of the Right WSTK needed by Commander")
+        print("or: python ZRADCalProgTest.py STATION=station.json for any number of jigs - see Station.py")
         print("Zebra Printer must be connected and powered on")
         print("TinySA Spectrum Analyzer must be connected and powered on")
         print("TinySA power button is a small slide switch on the side opposite the USB cable")
@@ -295,19 +532,20 @@ class ZRADCalProgTest:
         for device in device_list:  # print the COM ports for the necessary devices
             print(device)
             if device.vid == WSTK_VID and device.pid == WSTK_PID:
-                print("WSTK COM Port={}".format(device.device))
+                print("WSTK COM Port={} SN={}".format(device.device, device.serial_number))
             if device.vid == 0x0483 and device.pid == 0x5740:
-                print("TinySA COM Port={}".format(device.device))
-        rtn=subprocess.check_output("C:/SiliconLabs/SimplicityStudio/v5/developer/adapter_packs/commander/commander.exe --version",shell=True)
+                print("TinySA COM Port={} SN={}".format(device.device, device.serial_number))
+        rtn=subprocess.check_output([CMDR, "--version"])
         rtnsplit = rtn.decode().split('\r\n')
         for i in rtnsplit:
             if "SN=" in i: print(i)  # print the serial number of any connected WSTK ProKits
         print("")
         print("Commands:")
-        print(" x=exit - statistics will be printed (not yet)")
-        print(" <enter>=test the DUT in jig listed")
+        print(" x=exit - statistics will be printed")
+        print(" <enter>=start testing the DUT in the jig listed and switch to the other jig")
         print(" l=test the LEFT DUT")
         print(" r=test the RIGHT DUT")
+        print(" 1-9=select the jig by number")
         print(" F=Clear DUT flash to be Factory Fresh")
         print(" S=Program Secure Engine")
         print(" C=Run Crystal Calibration")
@@ -315,96 +553,165 @@ class ZRADCalProgTest:
         print(" t=Run the functional test")
         print(" Q=Generate QR Code Labels")
         print(" P=Print Labels of the last DUT")
+        print(" R [DSK, PIN or serial]=Reprint the labels of any DUT already tested - the last DUT in this jig if none given")
         print(" Z=Toggle label printing On/Off")
         print(" ?=Print this help message")
         print("")
 
-if __name__ == "__main__":
-    ''' This program is typically run as a command line program in a windows PowerShell or Linux bash shell '''
-
-    wstk=ZRADCalProgTest() # create the connection to both WSTKs
+def GetStation():
+    ''' Station configuration from STATION=file.json or the classic LCOM/RCOM/LSER/RSER two jig arguments '''
+    lcom, rcom, lser, rser = "COM4", None, "440263534", "456"
+    try:
+        for i in sys.argv:
+            if "STATION" in i:                  # See USAGE for details
+                return(Station.LoadStation(i.split('=')[1]))
+            elif "LCOM" in i:
+                lcom = i.split('=')[1]
+            elif "RCOM" in i:
+                rcom = i.split('=')[1]
+            elif "LSER" in i:
+                lser = i.split('=')[1]
+            elif "RSER" in i:
+                rser = i.split('=')[1]
+    except Exception as err:
+        print("failed to open devices:",err)
+        traceback.print_tb(err.__traceback__)
+        exit()
+    return(Station.DefaultStation(lcom, rcom, lser, rser))
+
+class JigWorker(threading.Thread):
+    ''' Background worker for one jig. Runs the commands the operator queues for that jig
+        so the console stays responsive and the other jig keeps working in the meantime.
+    '''
+
+    def __init__(self, jig):
+        super().__init__(daemon=True)
+        self.jig = jig
+        self.cmds = queue.Queue()
+        self.busy = False
+        self.goodUnits = 0
+        self.testedUnits = 0
+
+    def submit(self, cmd):
+        ''' queue a console command for this jig - returns immediately '''
+        self.busy = True
+        self.cmds.put(cmd)
+
+    def run(self):
+        Metrics.SetJig(self.jig.name)
+        while True:
+            cmd = self.cmds.get()
+            try:
+                self.runcmd(cmd)
+            except (Exception, SystemExit) as err:  # keep serving this jig - a dead worker would leave it busy for good
+                print("\n\r*** {} jig error: {}".format(self.jig.name, err))
+                traceback.print_tb(err.__traceback__)
+            finally:
+                self.busy = not self.cmds.empty()
+
+    def runcmd(self, cmd):
+        self.jig.state = None   # the DUT may have been swapped since the last command
+        self.jig.appFlashed = False
+        if 'P' not in cmd:      # P prints the labels of the last DUT
+            self.jig.qr = None
+        if len(cmd) == 0: # test the DUT
+            self.testedUnits += 1
+            if self.jig.TestDUT():
+                self.goodUnits += 1
+            else:
+                print("\n\r\n\r*** {} DUT FAILED ***\n\r".format(self.jig.name), flush=True)
+        elif 'F' in cmd:
+            self.jig.FactoryFresh()
+        elif 'S' in cmd:
+            self.jig.ProgramSecureEngine()
+        elif 'C' in cmd:
+            self.jig.CalibrateCrystal()
+        elif 'A' in cmd:
+            self.jig.FlashApplication()
+        elif 't' in cmd:
+            self.jig.QuickFunctionalTest()
+        elif 'Q' in cmd:
+            with self.jig.sched.use("printer"):
+                self.jig.CreateQRImages()
+        elif 'P' in cmd:
+            with self.jig.sched.use("printer"):
+                self.jig.zeb_print()
+        elif 'L' in cmd:
+            self.jig.LockDebugPort()
 
-    zeb=wstk.zeb_init()
+if __name__ == "__main__":
+    ''' This program is typically run as a command line program in a windows PowerShell or Linux bash shell
+        Each jig has its own worker thread so pressing enter starts the DUT in one jig and the console
+        immediately moves on to the next jig so the operator can load it while the others are running.
+    '''
+
+    station=GetStation()
+    Metrics.Open()  # every step, commander call, RailTest command and sweep is logged to metrics.csv
+    sched=Station.ResourceScheduler(station["resources"])
+    jigs=[ZRADCalProgTest(jig, sched, idx) for idx, jig in enumerate(station["jigs"])]   # one instance per jig
+
+    jigs[0].zeb_init()
+    for jig in jigs[1:]:
+        jig.zeb = jigs[0].zeb   # the label printer is shared
+        jig.spooler = jigs[0].spooler
+    results = ResultsDB.ResultsDB().start()   # every DUT is saved in results.db
+    analyzers = ZG23CrystalCal.AnalyzerPool(station.get("analyzers"))   # the TinySAs listed in the station or every one connected
+    for jig in jigs:
+        jig.results = results
+        jig.analyzers = analyzers
+
+    workers=[JigWorker(jig) for jig in jigs]
+    for worker in workers:
+        worker.start()
 
     if DEBUG>1: print("Begin Programming & Testing & QR Code Label Printing")
 
     cmd = ''
-    wstk.side = 0
-    DUT_side = ['LEFT', 'RIGHT']
-    DUT_arrow = ['<', '>']
+    side = 0
     starttime = time.time()
-    goodUnits=0
-    testedUnits=0
     while not ('x' in cmd):
-        #wstk.closewcom    # close the port just in case it was left open
-        print("Ready to test {}".format(DUT_side[wstk.side]),end="") 
-        cmd=input(DUT_arrow[wstk.side])
-        if len(cmd) == 0: # just pressed enter so test the DUT and switch at the end
-            testedUnits +=1
-            dutstarttime = time.time()
-            print("Testing {}".format(DUT_side[wstk.side]), flush=True)
-
-            good = wstk.ProgramSecureEngine() # 1) check SE and update if needed
-            if not good:  # SE programming failed so skip the rest - typically re-seat or replace the DUT
-                continue
-
-            good = wstk.CalibrateCrystal() # 2) Check Crystal calibration and calibrate if needed
-            if not good:
-                continue
-
-            good = wstk.FlashApplication() # 3) Flash the application, bootloader and keys
-            if not good:
-                continue
-
-            good = wstk.QuickFunctionalTest() # 4) Quick Functional Test
-            if not good:
-                continue
-
-            wstk.CreateQRImages()       # 5) generate the QR Code images
-
-            if not SKIP_PRINTING:
-                wstk.zeb_print()        # 6) print the labels
-
-            good = wstk.LockDebugPort() # 7) Lock the debug port
-            if not good:
-                continue
-
-            print("\n\r\n\r{} DUT PASSED {}{}{} in {} seconds\n\r".format(DUT_side[wstk.side],DUT_arrow[wstk.side],DUT_arrow[wstk.side],DUT_arrow[wstk.side],round(time.time()-dutstarttime,0)))
-
-            goodUnits +=1
-            if wstk.wstk[1] != None: wstk.side += 1 # only switch sides if there are 2 Jigs
-            if wstk.side>1: 
-                wstk.side=0
+        print("Ready to test {}".format(jigs[side].name),end="")
+        cmd=input(jigs[side].arrow)
+        if len(cmd) == 0: # just pressed enter so start the DUT and switch to the other jig
+            if workers[side].busy:
+                print("{} jig is still busy".format(jigs[side].name))
+            else:
+                workers[side].submit(cmd)
+            side = (side+1) % len(workers)  # move on to the next jig if there is more than 1
+        elif cmd[0] == 'R':     # reprint without re-testing
+            if len(cmd[1:].strip()) > 0:
+                jigs[0].spooler.Reprint(cmd[1:].strip())
+            elif jigs[side].qr:
+                jigs[0].spooler.Reprint(jigs[side].qr[12:52])
         elif 'l' in cmd:
-            wstk.side=0
+            side=0
         elif 'r' in cmd:
-            wstk.side=1
-        elif 'F' in cmd:
-            wstk.FactoryFresh()
-        elif 'S' in cmd:
-            wstk.ProgramSecureEngine()
-        elif 'C' in cmd:
-            wstk.CalibrateCrystal()
-        elif 'A' in cmd:
-            wstk.FlashApplication()
-        elif 't' in cmd:
-            wstk.QuickFunctionalTest()
-        elif 'Q' in cmd:
-            wstk.CreateQRImages() 
-        elif 'P' in cmd:
-            wstk.zeb_print()
-        elif 'L' in cmd:
-            wstk.LockDebugPort()
+            side=min(1,len(workers)-1)
+        elif cmd.isdigit() and 0 < int(cmd) <= len(workers):
+            side=int(cmd)-1
         elif 'Z' in cmd:
             if SKIP_PRINTING: SKIP_PRINTING=False
             else: SKIP_PRINTING=True
             print("SKIP_PRINTING=",SKIP_PRINTING)
         elif 'x' in cmd:
             pass
+        elif cmd[0] in "FSCAtQPL":
+            workers[side].submit(cmd)
         else:
             ZRADCalProgTest.usage()
 
+    while any(worker.busy for worker in workers):  # let any DUT in progress finish before exiting
+        time.sleep(0.5)
+
+    if len(jigs[0].spooler.Queued()) > 0:
+        print("{} labels have not printed yet - they will print the next time the station is started".format(len(jigs[0].spooler.Queued())))
+
+    testedUnits = sum(worker.testedUnits for worker in workers)
+    goodUnits = sum(worker.goodUnits for worker in workers)
     if testedUnits>1:
         print("Programming/testing for {} minutes. Total DUTs={}, Good DUTs={} {}%".format(round((time.time()-starttime)/60,0),testedUnits,goodUnits, int(round(100*(goodUnits/testedUnits),0))))
+        print(Metrics.Report())
+    results.close()
+    print(results.Report(since=starttime))
     time.sleep(1)
     exit()
@@ -3,6 +3,9 @@ import serial
 import numpy as np
 import pylab as pl
 import struct
+import time
+import threading
+from collections import deque
 from serial.tools import list_ports
 
 # These are generic ST USB->UART chip VID/PID so they are not certain to find the proper device
@@ -10,21 +13,36 @@ VID = 0x0483 #1155
 PID = 0x5740 #22336
 
 # Get tinysa device automatically
-def getport() -> str:
-    device_list = list_ports.comports()
-    for device in device_list:
-        if device.vid == VID and device.pid == PID:
-            return device.device
-    raise OSError("device not found")
+def getports() -> list:
+    ''' [(USB serial number, port)] of every tinysa connected sorted by serial number.
+        Some firmware versions report the same serial number on every unit - those can only be told apart by port.
+    '''
+    return sorted((device.serial_number or "", device.device) for device in list_ports.comports() if device.vid == VID and device.pid == PID)
+
+def getport(serial = None) -> str:
+    ''' port of the tinysa with the USB serial number - the first one found if None '''
+    for sn, port in getports():
+        if serial is None or sn == serial:
+            return port
+    raise OSError("device not found" if serial is None else "tinySA {} not found".format(serial))
 
 REF_LEVEL = (1<<9)
 
+PROMPT = b'ch>'
+
+# scanraw returns '{' then 'x' + a little endian uint16 for every point then '}'
+# level in dBm = value/32 - SCANRAW_OFFSET. The offset is 128 for the tinySA and 174 for the tinySA Ultra.
+SCANRAW_DTYPE = np.dtype([('x', 'u1'), ('v', '<u2')])
+SCANRAW_OFFSET = 128
+SCANRAW_OFFSET_ULTRA = 174
+
 class tinySA:
     def __init__(self, dev = None):
         self.dev = dev or getport()
         self.serial = None
         self._frequencies = None
         self.points = 101
+        self.scanraw_offset = SCANRAW_OFFSET    # set to SCANRAW_OFFSET_ULTRA for a tinySA Ultra
         
     @property
     def frequencies(self):
@@ -121,22 +139,30 @@ class tinySA:
         if data >= 1:
             self.send_command("rbw %d\r" % data)
         
-    def fetch_data(self):
-        result = ''
-        line = ''
+    def fetch_raw(self):
+        ''' Read everything up to the ch> prompt and return it as bytes (without the prompt).
+            Reads whatever has arrived in bulk instead of one byte at a time.
+        '''
+        buf = bytearray()
+        start = 0
         while True:
-            c = self.serial.read().decode('utf-8')
-            if c == chr(13):
-                next # ignore CR
-            line += c
-            if c == chr(10):
-                result += line
-                line = ''
-                next
-            if line.endswith('ch>'):
-                # stop on prompt
+            n = self.serial.in_waiting
+            buf += self.serial.read(n if n > 0 else 1)  # block for the next byte when nothing is waiting
+            i = buf.find(PROMPT, start)
+            if i >= 0:
                 break
-        return result
+            start = max(0, len(buf)-len(PROMPT)+1)   # the prompt may be split across reads
+        return bytes(buf[:i])
+
+    def fetch_data(self):
+        ''' Returns the text up to the ch> prompt, one line per result '''
+        raw = self.fetch_raw()
+        return raw[:raw.rfind(b'\n')+1].replace(b'\r', b'').decode('utf-8', errors='replace')
+
+    def fetch_values(self):
+        ''' Returns the numbers up to the ch> prompt as a numpy array - parsed straight from the buffer '''
+        raw = self.fetch_raw()
+        return np.array(raw[:raw.rfind(b'\n')+1].split(), dtype=np.float64)
 
 #    def fetch_array(self, sel):
 #        self.send_command("data %d\r" % sel)
@@ -192,22 +218,11 @@ class tinySA:
 
     def data(self, array = 2):
         self.send_command("data %d\r" % array)
-        data = self.fetch_data()
-        x = []
-        for line in data.split('\n'):
-            if line:
-                d = line.strip().split(' ')
-                x.append(float(line))
-        return np.array(x)
+        return self.fetch_values()
 
     def fetch_frequencies(self):
         self.send_command("frequencies\r")
-        data = self.fetch_data()
-        x = []
-        for line in data.split('\n'):
-            if line:
-                x.append(float(line))
-        self._frequencies = np.array(x)
+        self._frequencies = self.fetch_values()
 
     def send_scan(self, start = 1e6, stop = 900e6, points = None):
         if points:
@@ -215,6 +230,30 @@ class tinySA:
         else:
             self.send_command("scan %d %d\r"%(start, stop))
 
+    def scan_raw(self, start, stop, points, out = None):
+        ''' Binary sweep of any number of points using scanraw - returns the levels in dBm.
+            The levels are decoded straight from the serial buffer into out (a float64 numpy array of
+            length points) which is allocated if not passed in. Also sets frequencies to match the sweep.
+        '''
+        self.send_command("scanraw %d %d %d\r" % (start, stop, points))
+        while self.serial.read(1) != b'{':  # skip anything before the start of the data
+            pass
+        raw = self.serial.read(points * SCANRAW_DTYPE.itemsize)
+        if len(raw) != points * SCANRAW_DTYPE.itemsize:
+            raise IOError("scanraw returned {} bytes for {} points".format(len(raw), points))
+        self.fetch_raw()    # skip the closing '}' and the prompt
+        if out is None:
+            out = np.empty(points, dtype=np.float64)
+        np.multiply(np.frombuffer(raw, dtype=SCANRAW_DTYPE)['v'], 1/32, out=out)
+        out -= self.scanraw_offset
+        if self._frequencies is None or len(self._frequencies) != points or self._frequencies[0] != start or self._frequencies[-1] != stop:
+            self.set_frequencies(start, stop, points)
+        return out
+
+    def stream(self, start, stop, points, depth = 8):
+        ''' Returns a SpectrumStream that keeps the analyzer sweeping - see SpectrumStream '''
+        return SpectrumStream(self, start, stop, points, depth)
+
     def scan(self):
         segment_length = 101
         array0 = []
@@ -255,6 +294,88 @@ class tinySA:
             print("%d, "%self.frequencies[i], "%2.2f"%x[i], file=f)
 
 
+class SpectrumStream:
+    ''' Keeps the analyzer sweeping start..stop in a background thread and hands out the spectra as they arrive.
+        Only the last depth sweeps are kept so a slow consumer drops frames (counted in dropped) instead of using more memory.
+
+        with nv.stream(908.39e6, 908.45e6, 145) as st:
+            for timestamp, levels in st:            # levels in dBm, frequencies are in st.frequencies
+                ...
+            for timestamp, freq, level in st.peaks():   # or just the highest point of each sweep
+                ...
+    '''
+
+    def __init__(self, sa, start, stop, points, depth = 8):
+        self.sa = sa
+        self.start, self.stop, self.points = start, stop, points
+        self.frequencies = np.linspace(start, stop, points)
+        self.frames = deque(maxlen=depth)
+        self.cond = threading.Condition()
+        self.dropped = 0
+        self.error = None
+        self.running = False
+        self.thread = None
+
+    def begin(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def end(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.thread:
+            self.thread.join()
+        self.thread = None
+
+    def __enter__(self):
+        return self.begin()
+
+    def __exit__(self, *args):
+        self.end()
+
+    def _run(self):
+        try:
+            while self.running:
+                levels = self.sa.scan_raw(self.start, self.stop, self.points)
+                with self.cond:
+                    if len(self.frames) == self.frames.maxlen:
+                        self.dropped += 1   # the oldest frame falls off the ring
+                    self.frames.append((time.time(), levels))
+                    self.cond.notify_all()
+        except Exception as err:
+            self.error = err
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+
+    def get(self, timeout = None):
+        ''' Returns the oldest (timestamp, levels) not yet handed out - waits up to timeout seconds, None if there is none '''
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.frames or not self.running, timeout):
+                return None
+            if self.frames:
+                return self.frames.popleft()
+        if self.error:
+            raise self.error
+        return None
+
+    def __iter__(self):
+        while True:
+            frame = self.get()
+            if frame is None:
+                return
+            yield frame
+
+    def peaks(self):
+        ''' yields (timestamp, frequency, level) of the highest point of each sweep '''
+        for timestamp, levels in self:
+            i = int(np.argmax(levels))
+            yield timestamp, self.frequencies[i], levels[i]
+
+
 if __name__ == '__main__':
     from optparse import OptionParser
     parser = OptionParser(usage="%prog: [options]")
@@ -264,6 +385,12 @@ if __name__ == '__main__':
     parser.add_option("-c", "--scan", dest="scan",
                       action="store_true", default=False,
                       help="scan by script", metavar="SCAN")
+    parser.add_option("-r", "--raw", dest="raw",
+                      action="store_true", default=False,
+                      help="binary scan (scanraw) of any number of points", metavar="RAW")
+    parser.add_option("-m", "--monitor", dest="monitor",
+                      action="store_true", default=False,
+                      help="print the peak of each sweep continuously", metavar="MONITOR")
     parser.add_option("-S", "--start", dest="start",
                       type="float", default=1e6,
                       help="start frequency", metavar="START")
@@ -307,9 +434,19 @@ if __name__ == '__main__':
     if opt.start or opt.stop or opt.points:
         nv.set_frequencies(opt.start, opt.stop, opt.points)
 #    plot = opt.plot 
+    if opt.monitor:
+        with nv.stream(opt.start, opt.stop, opt.points) as st:
+            try:
+                for t, f, v in st.peaks():
+                    print("%.3f %d %2.2f dropped=%d" % (t, f, v, st.dropped))
+            except KeyboardInterrupt:
+                pass
+        exit(0)
     if opt.plot or opt.save or opt.scan:
         p = int(opt.port) if opt.port else 0
-        if opt.scan or opt.points > 101:
+        if opt.raw:
+            s = nv.scan_raw(opt.start, opt.stop, opt.points)
+        elif opt.scan or opt.points > 101:
             s = nv.scan()
             s = s[p]
         else: